@@ -5,20 +5,56 @@ Created by: Eng. Mohammad Abbas Alsaadon
 """
 
 import os
-import json
+import sys
+import orjson
 import sqlite3
+import queue
+import re
 import hashlib
+import hmac
 import secrets
+import tempfile
+import threading
+import time
+import unicodedata
+try:
+    import fcntl
+except ImportError:  # Windows development machines
+    fcntl = None
 from datetime import datetime, timedelta
-from functools import wraps
-from flask import Flask, render_template, request, redirect, url_for, session, jsonify, flash
+from concurrent.futures import ThreadPoolExecutor
+from functools import wraps, lru_cache
+from types import MappingProxyType
+from flask import Flask, render_template, request, redirect, url_for, session, jsonify, flash, g, has_app_context, send_file
+from flask.json.provider import DefaultJSONProvider
+from flask_caching import Cache
+from jinja2.utils import htmlsafe_json_dumps
 from dotenv import load_dotenv
+from argon2 import PasswordHasher
+from argon2.exceptions import VerificationError, InvalidHashError
+try:
+    from docx import Document
+    from docx.shared import Inches
+    from docx.enum.text import WD_ALIGN_PARAGRAPH
+    from docx.oxml.ns import nsdecls
+    from docx.oxml import parse_xml
+except ImportError:  # python-docx missing: Word export reports itself unavailable
+    Document = None
 
 # Load environment variables
 load_dotenv()
 
+class ORJSONProvider(DefaultJSONProvider):
+    """JSON provider backed by orjson for request parsing, jsonify and |tojson."""
+    
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=self.default, option=orjson.OPT_NON_STR_KEYS).decode()
+    
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
 app = Flask(__name__)
-app.secret_key = os.getenv('SECRET_KEY', secrets.token_hex(32))
+app.json = ORJSONProvider(app)
 app.permanent_session_lifetime = timedelta(hours=2)
 
 # Configuration
@@ -30,38 +66,187 @@ class Config:
     CREATOR_TITLE = "Consultant/Expert"
     COPYRIGHT_YEAR = "2026"
     DB_PATH = "mizan.db"
+    DB_POOL_SIZE = max(8, (os.cpu_count() or 1) * 2)
+    DB_BUSY_TIMEOUT_MS = 5000
+    DB_STATEMENT_CACHE_SIZE = 256
+    # Fixed rather than os.cpu_count(), which reports the host's CPUs inside containers;
+    # each concurrent Argon2 hash holds 46 MiB
+    KDF_WORKERS = max(1, int(os.getenv('KDF_WORKERS', '2')))
+    MIN_USERNAME_LENGTH = 3
+    MIN_PASSWORD_LENGTH = 6
+    MAX_PASSWORD_LENGTH = 1024  # Bounds the KDF work a single login attempt can trigger
+    AI_WORKERS = 12
+    DOCX_SPOOL_MAX_SIZE = 1024 * 1024
     OPENAI_API_KEY = os.getenv('OPENAI_API_KEY', '')
+    # Clamped to at least 1: zero would divide by zero in the throttle or deadlock its semaphore
+    OPENAI_MAX_RPM = max(1, int(os.getenv('OPENAI_MAX_RPM', '60')))
+    OPENAI_MAX_CONCURRENCY = max(1, int(os.getenv('OPENAI_MAX_CONCURRENCY', '8')))
+    # Gunicorn worker count (gunicorn_config.py reads the same variable); each worker
+    # throttles itself, so the account-wide RPM is split between them
+    WEB_CONCURRENCY = max(1, int(os.getenv('WEB_CONCURRENCY', '2')))
+    SECRET_KEY_PATH = os.path.expanduser('~/.mizan/secret')
 
 config = Config()
 
+def read_secret_key():
+    """Read the persisted secret key, refusing an empty file."""
+    with open(config.SECRET_KEY_PATH) as f:
+        key = f.read().strip()
+    if not key:
+        raise RuntimeError(f"{config.SECRET_KEY_PATH} is empty; delete it or set SECRET_KEY")
+    return key
+
+def persist_secret_key(key):
+    """Store a new key at SECRET_KEY_PATH; returns the key actually stored there."""
+    key_dir = os.path.dirname(config.SECRET_KEY_PATH)
+    os.makedirs(key_dir, exist_ok=True)
+    # Write the key in full to a temp file, then link it into place: the key file
+    # only ever appears complete, and if another worker linked first, use theirs
+    fd, tmp_path = tempfile.mkstemp(dir=key_dir)
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(key)
+        os.link(tmp_path, config.SECRET_KEY_PATH)
+    except FileExistsError:
+        return read_secret_key()
+    finally:
+        os.unlink(tmp_path)
+    return key
+
+def load_secret_key():
+    """Get SECRET_KEY from the environment, or a key generated once and persisted to disk."""
+    key = os.getenv('SECRET_KEY')
+    if key:
+        return key
+    try:
+        return read_secret_key()
+    except FileNotFoundError:
+        pass
+    print(f"Warning: SECRET_KEY not set, persisting a generated key to {config.SECRET_KEY_PATH}")
+    key = secrets.token_hex(32)
+    try:
+        return persist_secret_key(key)
+    except OSError as e:
+        # Read-only home, or a volume that refuses hard links: still boot, as before keys were persisted
+        print(f"Warning: could not persist SECRET_KEY ({e}); using a per-process key, "
+              f"so sessions will not survive restarts or be shared between workers")
+        return key
+
+# Stable across worker restarts so sessions (and their logins) survive
+app.secret_key = load_secret_key()
+
 # ============================================================================
 # DATABASE
 # ============================================================================
 
-def get_db():
-    """Get database connection."""
-    conn = sqlite3.connect(config.DB_PATH)
+# Idle connections are reused LIFO so the hottest connection (warm page cache) goes out first
+db_pool = queue.LifoQueue(maxsize=config.DB_POOL_SIZE)
+
+class PooledConnection:
+    """SQLite connection wrapper whose close() returns the connection to the pool."""
+    
+    def __init__(self, conn):
+        self._conn = conn
+    
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+    
+    def close(self):
+        if self._conn is not None:
+            release_db(self._conn)
+            self._conn = None
+
+def connect_db():
+    """Open a new SQLite connection with pragmas applied once per connection."""
+    conn = sqlite3.connect(config.DB_PATH, check_same_thread=False, isolation_level=None,
+                           cached_statements=config.DB_STATEMENT_CACHE_SIZE)
     conn.row_factory = sqlite3.Row
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.execute(f'PRAGMA busy_timeout={config.DB_BUSY_TIMEOUT_MS}')
+    conn.execute('PRAGMA temp_store=MEMORY')
+    conn.execute('PRAGMA mmap_size=268435456')
+    conn.execute('PRAGMA cache_size=-64000')
     return conn
 
-def init_db():
-    """Initialize database tables."""
+# Statements are kept as constants so pooled connections reuse their prepared plans
+INSERT_STRATEGY_SQL = '''INSERT INTO strategies (user_id, domain, org_name, sector, content, language)
+                         VALUES (?, ?, ?, ?, ?, ?)'''
+INSERT_POLICY_SQL = '''INSERT INTO policies (user_id, domain, policy_name, framework, content, language)
+                       VALUES (?, ?, ?, ?, ?, ?)'''
+INSERT_RISK_SQL = '''INSERT INTO risks (user_id, domain, asset_name, threat, risk_level, analysis)
+                     VALUES (?, ?, ?, ?, ?, ?)'''
+# Login needs only these columns (created_at feeds the session's user_meta);
+# username's UNIQUE index makes it a single B-tree seek
+SELECT_LOGIN_USER_SQL = 'SELECT id, username, password_hash, created_at FROM users WHERE username = ?'
+UPDATE_PASSWORD_HASH_SQL = 'UPDATE users SET password_hash = ? WHERE id = ?'
+SELECT_USER_META_SQL = 'SELECT id, username, created_at FROM users WHERE id = ?'
+# All three per-user counts in one round-trip; each subquery is an index-only scan
+DASHBOARD_COUNTS_SQL = '''SELECT (SELECT COUNT(*) FROM strategies WHERE user_id = :user_id),
+                                (SELECT COUNT(*) FROM policies WHERE user_id = :user_id),
+                                (SELECT COUNT(*) FROM risks WHERE user_id = :user_id)'''
+
+def get_db():
+    """Get database connection from the pool."""
+    try:
+        conn = db_pool.get_nowait()
+    except queue.Empty:
+        conn = connect_db()
+    pooled = PooledConnection(conn)
+    if has_app_context():
+        g.setdefault('db_connections', []).append(pooled)
+    return pooled
+
+def release_db(conn):
+    """Return a connection to the pool, closing it if the pool is full."""
+    if conn.in_transaction:
+        conn.rollback()
+    try:
+        db_pool.put_nowait(conn)
+    except queue.Full:
+        conn.close()
+
+@app.teardown_appcontext
+def release_request_connections(exc):
+    """Return connections a view left open (e.g. after an exception) to the pool."""
+    for pooled in g.pop('db_connections', ()):
+        pooled.close()
+
+# Saves of generated documents go to a single background writer, so the response
+# does not wait on the commit and writes reach SQLite one at a time
+db_writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='db-writer')
+
+def write_db(sql, params):
+    """Execute one write statement on a pooled connection."""
     conn = get_db()
-    cursor = conn.cursor()
-    
+    try:
+        conn.execute(sql, params)
+    except sqlite3.Error as db_error:
+        print(f"Database error: {db_error}")
+    finally:
+        conn.close()
+
+def queue_db_write(sql, params):
+    """Hand a write to the background writer and return immediately."""
+    db_writer.submit(write_db, sql, params)
+
+# Bump when the DDL in TABLE_SCHEMAS or INDEX_SCHEMAS changes
+SCHEMA_VERSION = 3
+
+# Portable equivalent of unixepoch() (which needs SQLite 3.38+)
+UNIX_NOW_SQL = "CAST(strftime('%s', 'now') AS INTEGER)"
+
+# Column definitions per table; created_at is stored as integer unix seconds
+TABLE_SCHEMAS = {
     # Users table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS users (
+    'users': f'''
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             username TEXT UNIQUE NOT NULL,
             password_hash TEXT NOT NULL,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
-    
+            created_at INTEGER NOT NULL DEFAULT ({UNIX_NOW_SQL})
+    ''',
     # Strategies table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS strategies (
+    'strategies': f'''
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             user_id INTEGER,
             domain TEXT,
@@ -69,14 +254,11 @@ def init_db():
             sector TEXT,
             content TEXT,
             language TEXT,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            created_at INTEGER NOT NULL DEFAULT ({UNIX_NOW_SQL}),
             FOREIGN KEY (user_id) REFERENCES users (id)
-        )
-    ''')
-    
+    ''',
     # Policies table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS policies (
+    'policies': f'''
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             user_id INTEGER,
             domain TEXT,
@@ -84,14 +266,11 @@ def init_db():
             framework TEXT,
             content TEXT,
             language TEXT,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            created_at INTEGER NOT NULL DEFAULT ({UNIX_NOW_SQL}),
             FOREIGN KEY (user_id) REFERENCES users (id)
-        )
-    ''')
-    
+    ''',
     # Risks table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS risks (
+    'risks': f'''
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             user_id INTEGER,
             domain TEXT,
@@ -99,13 +278,69 @@ def init_db():
             threat TEXT,
             risk_level TEXT,
             analysis TEXT,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            created_at INTEGER NOT NULL DEFAULT ({UNIX_NOW_SQL}),
             FOREIGN KEY (user_id) REFERENCES users (id)
-        )
-    ''')
-    
-    conn.commit()
-    conn.close()
+    '''
+}
+
+# Per-user listings filter on user_id and order by newest first
+INDEX_SCHEMAS = [
+    'CREATE INDEX IF NOT EXISTS idx_strategies_user ON strategies (user_id, created_at DESC)',
+    'CREATE INDEX IF NOT EXISTS idx_policies_user ON policies (user_id, created_at DESC)',
+    'CREATE INDEX IF NOT EXISTS idx_risks_user ON risks (user_id, created_at DESC)',
+    'CREATE INDEX IF NOT EXISTS idx_risks_user_domain ON risks (user_id, domain)'
+]
+
+def create_schema(cursor):
+    """Create database tables and indexes."""
+    for table, columns in TABLE_SCHEMAS.items():
+        cursor.execute(f'CREATE TABLE IF NOT EXISTS {table} ({columns})')
+    for index_sql in INDEX_SCHEMAS:
+        cursor.execute(index_sql)
+
+def migrate_timestamps_to_unix(cursor):
+    """Rebuild tables whose created_at is still a CURRENT_TIMESTAMP text column."""
+    for table, columns in TABLE_SCHEMAS.items():
+        info = {row['name']: row['type'] for row in cursor.execute(f'PRAGMA table_info({table})')}
+        if info.get('created_at', 'INTEGER') == 'INTEGER':
+            continue
+        # Create-copy-drop-rename (not rename-first) so foreign keys keep pointing at `table`
+        names = ', '.join(name for name in info if name != 'created_at')
+        cursor.execute(f'CREATE TABLE {table}_new ({columns})')
+        cursor.execute(f'''INSERT INTO {table}_new ({names}, created_at)
+                          SELECT {names}, COALESCE(CAST(strftime('%s', created_at) AS INTEGER), {UNIX_NOW_SQL})
+                          FROM {table}''')
+        cursor.execute(f'DROP TABLE {table}')
+        cursor.execute(f'ALTER TABLE {table}_new RENAME TO {table}')
+
+def get_schema_version(conn):
+    """Read the schema version stamped in the database header."""
+    return conn.execute('PRAGMA user_version').fetchone()[0]
+
+def init_db():
+    """Initialize database tables, skipping DDL when the schema is already current."""
+    conn = get_db()
+    try:
+        if get_schema_version(conn) >= SCHEMA_VERSION:
+            return
+        # Only one gunicorn worker runs the DDL; the others wait and re-check
+        with open(config.DB_PATH + '.init.lock', 'w') as lock_file:
+            if fcntl:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            # One write transaction for all DDL: a single commit/fsync, and no
+            # half-migrated schema if a statement fails
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                if get_schema_version(conn) < SCHEMA_VERSION:
+                    migrate_timestamps_to_unix(conn.cursor())
+                    create_schema(conn.cursor())
+                    conn.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+    finally:
+        conn.close()
 
 # Initialize database on startup
 init_db()
@@ -114,27 +349,69 @@ init_db()
 # AUTHENTICATION
 # ============================================================================
 
+# Argon2id with OWASP's recommended parameters (46 MiB, t=3, p=1)
+password_hasher = PasswordHasher(time_cost=3, memory_cost=46 * 1024, parallelism=1)
+
+# Argon2 and PBKDF2 release the GIL, so a thread pool caps concurrent hashes (and their
+# memory) per worker without a process pool's pickling and per-worker fork cost
+kdf_pool = ThreadPoolExecutor(max_workers=config.KDF_WORKERS, thread_name_prefix='kdf')
+
 def hash_password(password):
-    """Hash password with salt."""
-    salt = secrets.token_hex(16)
+    """Hash password with Argon2id (salt is embedded in the encoded hash)."""
+    return kdf_pool.submit(password_hasher.hash, password).result()
+
+def is_legacy_hash(stored_hash):
+    """Check if a stored hash uses the legacy PBKDF2 'salt$hash' format."""
+    return not stored_hash.startswith('$argon2')
+
+def verify_legacy_password(password, stored_hash):
+    """Verify password against a legacy PBKDF2-HMAC-SHA256 hash."""
+    try:
+        salt, hash_hex = stored_hash.split('$', 1)
+        expected = bytes.fromhex(hash_hex)
+    except ValueError:
+        return False
     hash_obj = hashlib.pbkdf2_hmac('sha256', password.encode(), salt.encode(), 100000)
-    return f"{salt}${hash_obj.hex()}"
+    return hmac.compare_digest(hash_obj, expected)
 
 def verify_password(password, stored_hash):
     """Verify password against stored hash."""
+    if is_legacy_hash(stored_hash):
+        return kdf_pool.submit(verify_legacy_password, password, stored_hash).result()
     try:
-        salt, hash_value = stored_hash.split('$')
-        hash_obj = hashlib.pbkdf2_hmac('sha256', password.encode(), salt.encode(), 100000)
-        return hash_obj.hex() == hash_value
-    except:
+        return kdf_pool.submit(password_hasher.verify, stored_hash, password).result()
+    except (VerificationError, InvalidHashError):
         return False
 
+@lru_cache(maxsize=1)
+def get_dummy_hash():
+    """Hash of a random password with the current parameters, used for unknown usernames."""
+    return password_hasher.hash(secrets.token_urlsafe(16))
+
+def needs_rehash(stored_hash):
+    """Check if a stored hash should be upgraded to the current Argon2id parameters."""
+    return is_legacy_hash(stored_hash) or password_hasher.check_needs_rehash(stored_hash)
+
 def login_required(f):
     """Decorator to require login."""
     @wraps(f)
     def decorated_function(*args, **kwargs):
-        if 'user_id' not in session:
+        # Read the signed session once; handlers use g.user_id and g.user_meta from here on
+        user_id = session.get('user_id')
+        if user_id is None:
             return redirect(url_for('login'))
+        user_meta = session.get('user_meta')
+        if user_meta is None:
+            # Sessions issued before user_meta existed: fill it in once instead of logging them out
+            conn = get_db()
+            user = conn.execute(SELECT_USER_META_SQL, (user_id,)).fetchone()
+            conn.close()
+            if user is None:
+                return redirect(url_for('login'))
+            user_meta = session['user_meta'] = {'id': user['id'], 'username': user['username'],
+                                                'created_at': user['created_at']}
+        g.user_id = user_id
+        g.user_meta = user_meta
         return f(*args, **kwargs)
     return decorated_function
 
@@ -142,114 +419,57 @@ def login_required(f):
 # TRANSLATIONS
 # ============================================================================
 
-TRANSLATIONS = {
-    "en": {
-        "app_name": "Mizan",
-        "tagline": "Governance • Risk • Compliance",
-        "login": "Sign In",
-        "register": "Register",
-        "logout": "Logout",
-        "username": "Username",
-        "password": "Password",
-        "welcome": "Welcome to Enterprise GRC Platform",
-        "welcome_sub": "Secure • Compliant • Intelligent",
-        "disclaimer": "AI-generated content. Verify with professionals.",
-        "no_sensitive": "Do not enter sensitive or confidential data",
-        "domains": ["Cyber Security", "Data Management", "Artificial Intelligence", "Digital Transformation", "Global Standards"],
-        "tabs": ["Strategy", "Policy Lab", "Audit", "Risk Radar"],
-        "org_name": "Organization Name",
-        "sector": "Sector",
-        "sectors": ["Government", "Banking/Finance", "Healthcare", "Energy", "Telecom", "Retail", "Manufacturing"],
-        "size": "Organization Size",
-        "sizes": ["Small (<100)", "Medium (100-1000)", "Large (1000+)"],
-        "budget": "Budget Range",
-        "budgets": ["< 1M SAR", "1M-5M SAR", "5M-20M SAR", "20M+ SAR"],
-        "frameworks": "Regulatory Frameworks",
-        "horizon": "Strategic Horizon (Months)",
-        "generate": "Generate Strategy",
-        "generating": "Generating...",
-        "current_state": "Current State Assessment",
-        "technologies": "Current Technologies",
-        "challenges": "Key Challenges",
-        "strategy_sections": {
-            "vision": "Executive Vision & Strategic Objectives",
-            "gaps": "Current State Assessment (Gap Analysis)",
-            "pillars": "Strategic Pillars & Initiatives",
-            "roadmap": "Implementation Roadmap",
-            "kpis": "Measuring Success (KPIs & KRIs)",
-            "confidence": "Confidence Score"
-        },
-        "policy_name": "Policy Title",
-        "policy_framework": "Framework/Standard",
-        "generate_policy": "Generate Policy",
-        "risk_category": "Risk Category",
-        "risk_scenario": "Risk Scenario",
-        "asset_name": "Asset Name",
-        "analyze_risk": "Analyze Risk",
-        "download": "Download",
-        "created_by": "Created by",
-        "settings": "Settings",
-        "clear_history": "Clear History",
-        "ai_connected": "AI Core Connected",
-        "ai_disconnected": "Simulation Mode",
-        "logged_in_as": "Logged in as"
-    },
-    "ar": {
-        "app_name": "ميزان",
-        "tagline": "الحوكمة • المخاطر • الامتثال",
-        "login": "تسجيل الدخول",
-        "register": "إنشاء حساب",
-        "logout": "تسجيل الخروج",
-        "username": "اسم المستخدم",
-        "password": "كلمة المرور",
-        "welcome": "مرحباً بك في منصة حوكمة المؤسسات",
-        "welcome_sub": "آمن • ممتثل • ذكي",
-        "disclaimer": "محتوى مُنشأ بالذكاء الاصطناعي. يُرجى التحقق مع المختصين.",
-        "no_sensitive": "لا تدخل بيانات حساسة أو سرية",
-        "domains": ["الأمن السيبراني", "إدارة البيانات", "الذكاء الاصطناعي", "التحول الرقمي", "المعايير العالمية"],
-        "tabs": ["الاستراتيجية", "معمل السياسات", "التدقيق", "رادار المخاطر"],
-        "org_name": "اسم المنظمة",
-        "sector": "القطاع",
-        "sectors": ["حكومي", "بنوك/مالي", "رعاية صحية", "طاقة", "اتصالات", "تجزئة", "تصنيع"],
-        "size": "حجم المنظمة",
-        "sizes": ["صغيرة (أقل من 100)", "متوسطة (100-1000)", "كبيرة (أكثر من 1000)"],
-        "budget": "نطاق الميزانية",
-        "budgets": ["< 1 مليون ريال", "1-5 مليون ريال", "5-20 مليون ريال", "20+ مليون ريال"],
-        "frameworks": "الأطر التنظيمية",
-        "horizon": "الأفق الاستراتيجي (أشهر)",
-        "generate": "إنشاء الاستراتيجية",
-        "generating": "جاري الإنشاء...",
-        "current_state": "تقييم الوضع الحالي",
-        "technologies": "التقنيات الحالية",
-        "challenges": "التحديات الرئيسية",
-        "strategy_sections": {
-            "vision": "الرؤية التنفيذية والأهداف الاستراتيجية",
-            "gaps": "تقييم الوضع الراهن (تحليل الفجوات)",
-            "pillars": "الركائز الاستراتيجية والمبادرات",
-            "roadmap": "خارطة طريق التنفيذ",
-            "kpis": "قياس النجاح (مؤشرات الأداء والمخاطر)",
-            "confidence": "درجة الثقة والتحقق"
-        },
-        "policy_name": "عنوان السياسة",
-        "policy_framework": "الإطار/المعيار",
-        "generate_policy": "إنشاء السياسة",
-        "risk_category": "فئة المخاطر",
-        "risk_scenario": "سيناريو الخطر",
-        "asset_name": "اسم الأصل",
-        "analyze_risk": "تحليل الخطر",
-        "download": "تحميل",
-        "created_by": "تم الإنشاء بواسطة",
-        "settings": "الإعدادات",
-        "clear_history": "مسح السجل",
-        "ai_connected": "الذكاء الاصطناعي متصل",
-        "ai_disconnected": "وضع المحاكاة",
-        "logged_in_as": "مسجل الدخول كـ"
-    }
-}
+def freeze_tree(tree, depth):
+    """Wrap the top `depth` levels of a nested dict in read-only mapping proxies."""
+    if depth == 0 or not isinstance(tree, dict):
+        return tree
+    return MappingProxyType({key: freeze_tree(value, depth - 1) for key, value in tree.items()})
+
+# Translation and per-domain trees live in locales/ and are loaded on first use,
+# so a worker only holds the languages and domains it has actually served
+LOCALES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'locales')
+SUPPORTED_LANGUAGES = ('en', 'ar')
+
+def intern_tree(tree):
+    """Recursively intern keys and string leaves so repeated labels share one object."""
+    if isinstance(tree, str):
+        return sys.intern(tree)
+    if isinstance(tree, list):
+        return [intern_tree(item) for item in tree]
+    if isinstance(tree, dict):
+        return {sys.intern(key): intern_tree(value) for key, value in tree.items()}
+    return tree
+
+def load_locale_file(*parts):
+    """Load a JSON file from the locales directory."""
+    with open(os.path.join(LOCALES_DIR, *parts), 'rb') as f:
+        return intern_tree(orjson.loads(f.read()))
 
 def get_text(lang='en'):
     """Get translations for language."""
-    return TRANSLATIONS.get(lang, TRANSLATIONS['en'])
+    # Normalize before the cache so arbitrary ?lang= values cannot evict the real entries
+    return load_translations(lang if lang in SUPPORTED_LANGUAGES else 'en')
+
+@lru_cache(maxsize=len(SUPPORTED_LANGUAGES))
+def load_translations(lang):
+    """Load a supported language's translations once per process."""
+    # Static data is shared by every request; expose a read-only view so nothing can mutate it
+    return freeze_tree(load_locale_file(f'{lang}.json'), 1)
+
+@app.before_request
+def resolve_language():
+    """Resolve the UI language once per request from ?lang= or the session."""
+    if request.endpoint == 'static':
+        return
+    lang = request.args.get('lang') or session.get('lang', 'en')
+    if lang not in SUPPORTED_LANGUAGES:
+        lang = 'en'
+    g.lang = lang
+    g.txt = get_text(lang)
+    g.is_rtl = lang == 'ar'
+    # Only touch the session when the language changes, so unchanged requests do not rewrite it
+    if session.get('lang') != lang:
+        session['lang'] = lang
 
 # ============================================================================
 # DOMAIN DATA
@@ -275,271 +495,194 @@ DOMAIN_FRAMEWORKS = {
     "global": ["ISO 27001:2022", "ISO 22301", "NIST CSF 2.0", "ISO 9001", "ISO 31000"]
 }
 
-# Domain-specific foundational technologies/controls
-DOMAIN_TECHNOLOGIES = {
-    "cyber": {
-        "en": {
-            "Security Operations": ["SIEM", "SOAR", "SOC", "Threat Intelligence Platform", "Log Management"],
-            "Endpoint Security": ["EDR/XDR", "Antivirus/Anti-malware", "Mobile Device Management (MDM)", "Endpoint DLP"],
-            "Network Security": ["Next-Gen Firewall", "IDS/IPS", "Network Access Control (NAC)", "Web Proxy", "DNS Security"],
-            "Identity & Access": ["IAM", "PAM", "MFA/2FA", "SSO", "Directory Services (AD/LDAP)"],
-            "Data Protection": ["DLP", "Encryption (at-rest/in-transit)", "Backup & Recovery", "Data Classification"],
-            "Application Security": ["WAF", "SAST/DAST", "API Security", "Code Review Tools"],
-            "Cloud Security": ["CASB", "CSPM", "CWPP", "Cloud IAM"],
-            "GRC Tools": ["Vulnerability Scanner", "Penetration Testing", "Compliance Management", "Risk Register"]
-        },
-        "ar": {
-            "العمليات الأمنية": ["SIEM", "SOAR", "مركز العمليات الأمنية", "منصة استخبارات التهديدات", "إدارة السجلات"],
-            "أمن النقاط الطرفية": ["EDR/XDR", "مكافحة الفيروسات", "إدارة الأجهزة المحمولة", "DLP للنقاط الطرفية"],
-            "أمن الشبكات": ["جدار الحماية المتقدم", "IDS/IPS", "التحكم بالوصول للشبكة", "بروكسي الويب", "أمن DNS"],
-            "الهوية والوصول": ["IAM", "PAM", "المصادقة متعددة العوامل", "SSO", "خدمات الدليل"],
-            "حماية البيانات": ["DLP", "التشفير", "النسخ الاحتياطي والاستعادة", "تصنيف البيانات"],
-            "أمن التطبيقات": ["WAF", "SAST/DAST", "أمن API", "أدوات مراجعة الكود"],
-            "أمن السحابة": ["CASB", "CSPM", "CWPP", "IAM السحابي"],
-            "أدوات الحوكمة": ["ماسح الثغرات", "اختبار الاختراق", "إدارة الامتثال", "سجل المخاطر"]
-        }
-    },
-    "data": {
-        "en": {
-            "Data Governance": ["Data Catalog", "Metadata Management", "Data Lineage", "Business Glossary"],
-            "Data Quality": ["Data Profiling", "Data Cleansing", "Master Data Management (MDM)", "Data Validation"],
-            "Data Security": ["Data Masking", "Tokenization", "Database Encryption", "Access Controls"],
-            "Data Privacy": ["Consent Management", "Privacy Impact Assessment", "Data Subject Rights Management", "Cookie Management"],
-            "Data Integration": ["ETL/ELT Tools", "Data Virtualization", "API Management", "Data Replication"],
-            "Data Analytics": ["BI Platform", "Data Warehouse", "Data Lake", "Reporting Tools"],
-            "Data Lifecycle": ["Archiving Solutions", "Retention Management", "Secure Disposal", "Backup Systems"]
-        },
-        "ar": {
-            "حوكمة البيانات": ["كتالوج البيانات", "إدارة البيانات الوصفية", "تتبع مسار البيانات", "قاموس الأعمال"],
-            "جودة البيانات": ["تحليل البيانات", "تنظيف البيانات", "إدارة البيانات الرئيسية", "التحقق من البيانات"],
-            "أمن البيانات": ["إخفاء البيانات", "الترميز", "تشفير قواعد البيانات", "ضوابط الوصول"],
-            "خصوصية البيانات": ["إدارة الموافقات", "تقييم أثر الخصوصية", "إدارة حقوق أصحاب البيانات", "إدارة الكوكيز"],
-            "تكامل البيانات": ["أدوات ETL/ELT", "المحاكاة الافتراضية للبيانات", "إدارة API", "نسخ البيانات"],
-            "تحليل البيانات": ["منصة ذكاء الأعمال", "مستودع البيانات", "بحيرة البيانات", "أدوات التقارير"],
-            "دورة حياة البيانات": ["حلول الأرشفة", "إدارة الاحتفاظ", "الإتلاف الآمن", "أنظمة النسخ الاحتياطي"]
-        }
-    },
-    "ai": {
-        "en": {
-            "ML Infrastructure": ["ML Platform", "Model Registry", "Feature Store", "Experiment Tracking"],
-            "Data for AI": ["Data Labeling", "Training Data Management", "Synthetic Data Generation", "Data Versioning"],
-            "Model Development": ["AutoML", "Notebook Environment", "Model Training Pipeline", "Hyperparameter Tuning"],
-            "Model Operations": ["Model Deployment", "Model Monitoring", "A/B Testing", "Model Versioning"],
-            "AI Governance": ["Model Documentation", "Bias Detection", "Explainability Tools", "Audit Trail"],
-            "AI Security": ["Adversarial Testing", "Model Encryption", "Secure Inference", "Access Controls"]
-        },
-        "ar": {
-            "بنية تعلم الآلة": ["منصة ML", "سجل النماذج", "مخزن الميزات", "تتبع التجارب"],
-            "بيانات الذكاء الاصطناعي": ["تصنيف البيانات", "إدارة بيانات التدريب", "توليد البيانات الاصطناعية", "إصدارات البيانات"],
-            "تطوير النماذج": ["AutoML", "بيئة Notebook", "خط أنابيب التدريب", "ضبط المعاملات"],
-            "عمليات النماذج": ["نشر النماذج", "مراقبة النماذج", "اختبار A/B", "إصدارات النماذج"],
-            "حوكمة الذكاء الاصطناعي": ["توثيق النماذج", "كشف التحيز", "أدوات التفسير", "سجل المراجعة"],
-            "أمن الذكاء الاصطناعي": ["الاختبار العدائي", "تشفير النماذج", "الاستدلال الآمن", "ضوابط الوصول"]
-        }
-    },
-    "dt": {
-        "en": {
-            "Digital Platforms": ["Enterprise Portal", "Mobile Apps", "Customer Experience Platform", "Digital Workplace"],
-            "Integration": ["ESB/Integration Platform", "API Gateway", "iPaaS", "Microservices"],
-            "Process Automation": ["RPA", "BPM", "Workflow Engine", "Low-Code Platform"],
-            "Cloud Services": ["IaaS", "PaaS", "SaaS", "Hybrid Cloud"],
-            "Analytics & Insights": ["Big Data Platform", "Real-time Analytics", "Predictive Analytics", "Dashboard/KPI Tools"],
-            "Collaboration": ["Unified Communications", "Document Management", "Project Management", "Knowledge Management"],
-            "Customer Engagement": ["CRM", "Marketing Automation", "Chatbots", "Omnichannel Platform"]
-        },
-        "ar": {
-            "المنصات الرقمية": ["البوابة المؤسسية", "تطبيقات الجوال", "منصة تجربة العميل", "مكان العمل الرقمي"],
-            "التكامل": ["منصة التكامل", "بوابة API", "iPaaS", "الخدمات المصغرة"],
-            "أتمتة العمليات": ["RPA", "إدارة العمليات", "محرك سير العمل", "منصة Low-Code"],
-            "الخدمات السحابية": ["IaaS", "PaaS", "SaaS", "السحابة الهجينة"],
-            "التحليلات": ["منصة البيانات الضخمة", "التحليلات الفورية", "التحليلات التنبؤية", "لوحات المؤشرات"],
-            "التعاون": ["الاتصالات الموحدة", "إدارة الوثائق", "إدارة المشاريع", "إدارة المعرفة"],
-            "تفاعل العملاء": ["CRM", "أتمتة التسويق", "روبوتات المحادثة", "منصة القنوات المتعددة"]
-        }
-    },
-    "global": {
-        "en": {
-            "Quality Management": ["QMS Software", "Document Control", "CAPA Management", "Audit Management"],
-            "Risk Management": ["ERM Platform", "Risk Register", "Risk Assessment Tools", "Incident Management"],
-            "Compliance": ["Compliance Management", "Policy Management", "Training Management", "Certification Tracking"],
-            "Business Continuity": ["BCP Platform", "DR Solutions", "Crisis Management", "Emergency Notification"],
-            "Information Security": ["ISMS Platform", "Asset Management", "Vulnerability Management", "Security Awareness"]
-        },
-        "ar": {
-            "إدارة الجودة": ["برنامج QMS", "التحكم بالوثائق", "إدارة CAPA", "إدارة التدقيق"],
-            "إدارة المخاطر": ["منصة ERM", "سجل المخاطر", "أدوات تقييم المخاطر", "إدارة الحوادث"],
-            "الامتثال": ["إدارة الامتثال", "إدارة السياسات", "إدارة التدريب", "تتبع الشهادات"],
-            "استمرارية الأعمال": ["منصة BCP", "حلول DR", "إدارة الأزمات", "الإشعارات الطارئة"],
-            "أمن المعلومات": ["منصة ISMS", "إدارة الأصول", "إدارة الثغرات", "التوعية الأمنية"]
-        }
-    }
-}
-
-# Enhanced Risk Categories with scenarios
-RISK_CATEGORIES = {
-    "cyber": {
-        "en": {
-            "Access Control": ["Unauthorized access to systems", "Privilege escalation", "Credential theft", "Insider threat", "Session hijacking"],
-            "Network Security": ["Network intrusion", "DDoS attack", "Man-in-the-middle attack", "DNS poisoning", "Lateral movement"],
-            "Data Protection": ["Data breach", "Data leakage", "Unauthorized data access", "Data corruption", "Ransomware encryption"],
-            "Endpoint Security": ["Malware infection", "Zero-day exploit", "USB-based attack", "Remote access trojan", "Cryptomining"],
-            "Application Security": ["SQL injection", "XSS attack", "API abuse", "Broken authentication", "Insecure deserialization"],
-            "Cloud Security": ["Cloud misconfiguration", "Data exposure in cloud", "Account hijacking", "Insecure APIs", "Shadow IT"],
-            "Social Engineering": ["Phishing attack", "Spear phishing", "Business email compromise", "Vishing", "Pretexting"],
-            "Third Party Risk": ["Vendor breach", "Supply chain attack", "Third-party data exposure", "Service provider failure"],
-            "Operational Technology": ["SCADA attack", "ICS compromise", "Physical-cyber attack", "OT network breach"],
-            "Incident Response": ["Delayed detection", "Inadequate response", "Evidence loss", "Communication failure"]
-        },
-        "ar": {
-            "التحكم بالوصول": ["وصول غير مصرح للأنظمة", "تصعيد الصلاحيات", "سرقة بيانات الاعتماد", "التهديد الداخلي", "اختطاف الجلسة"],
-            "أمن الشبكات": ["اختراق الشبكة", "هجوم DDoS", "هجوم الوسيط", "تسميم DNS", "الحركة الجانبية"],
-            "حماية البيانات": ["خرق البيانات", "تسرب البيانات", "وصول غير مصرح للبيانات", "تلف البيانات", "تشفير الفدية"],
-            "أمن النقاط الطرفية": ["إصابة بالبرمجيات الخبيثة", "استغلال يوم الصفر", "هجوم USB", "حصان طروادة", "التعدين الخبيث"],
-            "أمن التطبيقات": ["حقن SQL", "هجوم XSS", "إساءة استخدام API", "مصادقة معطلة", "إلغاء تسلسل غير آمن"],
-            "أمن السحابة": ["سوء تكوين السحابة", "كشف البيانات السحابية", "اختطاف الحساب", "APIs غير آمنة", "Shadow IT"],
-            "الهندسة الاجتماعية": ["هجوم التصيد", "التصيد الموجه", "اختراق البريد التجاري", "التصيد الصوتي", "الذريعة"],
-            "مخاطر الأطراف الثالثة": ["اختراق المورد", "هجوم سلسلة التوريد", "كشف بيانات الطرف الثالث", "فشل مزود الخدمة"],
-            "التقنيات التشغيلية": ["هجوم SCADA", "اختراق ICS", "هجوم فيزيائي-سيبراني", "اختراق شبكة OT"],
-            "الاستجابة للحوادث": ["تأخر الكشف", "استجابة غير كافية", "فقدان الأدلة", "فشل الاتصال"]
-        }
-    },
-    "data": {
-        "en": {
-            "Data Quality": ["Incomplete data", "Duplicate records", "Data inconsistency", "Outdated information", "Invalid data formats"],
-            "Data Privacy": ["Personal data exposure", "Consent violation", "Cross-border transfer issues", "Right to erasure failure", "Purpose limitation breach"],
-            "Data Governance": ["Undefined data ownership", "Missing data lineage", "Inconsistent data definitions", "Policy non-compliance", "Metadata gaps"],
-            "Data Security": ["Unauthorized data access", "Database breach", "Encryption failure", "Backup exposure", "Insider data theft"],
-            "Data Lifecycle": ["Retention policy violation", "Improper disposal", "Archive corruption", "Recovery failure", "Storage overflow"],
-            "Data Integration": ["ETL failure", "Data sync issues", "API data exposure", "Migration errors", "Real-time feed disruption"],
-            "Regulatory Compliance": ["PDPL violation", "GDPR non-compliance", "Audit findings", "Reporting failures", "Documentation gaps"]
-        },
-        "ar": {
-            "جودة البيانات": ["بيانات ناقصة", "سجلات مكررة", "عدم اتساق البيانات", "معلومات قديمة", "تنسيقات بيانات غير صالحة"],
-            "خصوصية البيانات": ["كشف البيانات الشخصية", "انتهاك الموافقة", "مشاكل النقل عبر الحدود", "فشل حق المحو", "انتهاك تحديد الغرض"],
-            "حوكمة البيانات": ["ملكية بيانات غير محددة", "مسار بيانات مفقود", "تعريفات بيانات غير متسقة", "عدم الامتثال للسياسة", "فجوات البيانات الوصفية"],
-            "أمن البيانات": ["وصول غير مصرح للبيانات", "اختراق قاعدة البيانات", "فشل التشفير", "كشف النسخ الاحتياطية", "سرقة البيانات الداخلية"],
-            "دورة حياة البيانات": ["انتهاك سياسة الاحتفاظ", "التخلص غير السليم", "تلف الأرشيف", "فشل الاستعادة", "تجاوز التخزين"],
-            "تكامل البيانات": ["فشل ETL", "مشاكل مزامنة البيانات", "كشف بيانات API", "أخطاء الترحيل", "انقطاع التغذية الفورية"],
-            "الامتثال التنظيمي": ["انتهاك PDPL", "عدم الامتثال لـ GDPR", "نتائج التدقيق", "فشل التقارير", "فجوات التوثيق"]
-        }
-    },
-    "ai": {
-        "en": {
-            "Model Bias": ["Demographic bias", "Selection bias", "Measurement bias", "Algorithmic discrimination", "Feedback loop bias"],
-            "Data Quality for AI": ["Training data poisoning", "Label errors", "Data drift", "Insufficient training data", "Unrepresentative samples"],
-            "Model Performance": ["Model degradation", "Concept drift", "Overfitting", "Underfitting", "Poor generalization"],
-            "Explainability": ["Black box decisions", "Lack of interpretability", "Unexplainable outcomes", "Audit trail gaps", "Stakeholder confusion"],
-            "AI Security": ["Adversarial attacks", "Model theft", "Model inversion", "Data extraction attacks", "Prompt injection"],
-            "Ethical Concerns": ["Autonomous harm", "Privacy invasion", "Unfair treatment", "Manipulation", "Job displacement"],
-            "Operational Risks": ["Model failure in production", "Integration issues", "Scalability problems", "Resource constraints", "Dependency failures"],
-            "Compliance": ["Regulatory non-compliance", "Documentation gaps", "Consent issues", "Cross-border AI use", "Audit failures"]
-        },
-        "ar": {
-            "تحيز النموذج": ["تحيز ديموغرافي", "تحيز الاختيار", "تحيز القياس", "تمييز خوارزمي", "تحيز حلقة التغذية"],
-            "جودة بيانات الذكاء الاصطناعي": ["تسميم بيانات التدريب", "أخطاء التصنيف", "انحراف البيانات", "بيانات تدريب غير كافية", "عينات غير ممثلة"],
-            "أداء النموذج": ["تدهور النموذج", "انحراف المفهوم", "الإفراط في التخصيص", "نقص التخصيص", "ضعف التعميم"],
-            "قابلية التفسير": ["قرارات الصندوق الأسود", "نقص قابلية التفسير", "نتائج غير قابلة للتفسير", "فجوات سجل المراجعة", "إرباك أصحاب المصلحة"],
-            "أمن الذكاء الاصطناعي": ["الهجمات العدائية", "سرقة النموذج", "عكس النموذج", "هجمات استخراج البيانات", "حقن الأوامر"],
-            "المخاوف الأخلاقية": ["الضرر المستقل", "انتهاك الخصوصية", "المعاملة غير العادلة", "التلاعب", "استبدال الوظائف"],
-            "المخاطر التشغيلية": ["فشل النموذج في الإنتاج", "مشاكل التكامل", "مشاكل قابلية التوسع", "قيود الموارد", "فشل التبعيات"],
-            "الامتثال": ["عدم الامتثال التنظيمي", "فجوات التوثيق", "مشاكل الموافقة", "استخدام AI عبر الحدود", "فشل التدقيق"]
-        }
-    },
-    "dt": {
-        "en": {
-            "Change Management": ["Resistance to change", "Inadequate training", "Cultural barriers", "Communication gaps", "Leadership misalignment"],
-            "Technology Integration": ["System incompatibility", "Data migration failures", "API integration issues", "Legacy system constraints", "Vendor lock-in"],
-            "Digital Skills": ["Skills shortage", "Knowledge gaps", "Training inadequacy", "Talent retention", "Digital literacy"],
-            "Process Disruption": ["Workflow disruption", "Process automation failure", "Business continuity impact", "Operational inefficiency", "Service degradation"],
-            "Customer Experience": ["Poor digital experience", "Channel inconsistency", "Accessibility issues", "Response time delays", "Customer data exposure"],
-            "Strategic Alignment": ["Misaligned objectives", "ROI uncertainty", "Scope creep", "Priority conflicts", "Resource constraints"],
-            "Vendor & Cloud": ["Vendor dependency", "Cloud service outage", "Contract issues", "Cost overruns", "SLA breaches"],
-            "Security in Transformation": ["Security gaps during migration", "New attack surfaces", "Access control issues", "Data exposure", "Compliance gaps"]
-        },
-        "ar": {
-            "إدارة التغيير": ["مقاومة التغيير", "تدريب غير كافٍ", "حواجز ثقافية", "فجوات الاتصال", "عدم توافق القيادة"],
-            "تكامل التقنية": ["عدم توافق الأنظمة", "فشل ترحيل البيانات", "مشاكل تكامل API", "قيود الأنظمة القديمة", "الارتباط بالمورد"],
-            "المهارات الرقمية": ["نقص المهارات", "فجوات المعرفة", "قصور التدريب", "الاحتفاظ بالمواهب", "الثقافة الرقمية"],
-            "تعطيل العمليات": ["تعطيل سير العمل", "فشل أتمتة العمليات", "تأثير استمرارية الأعمال", "عدم كفاءة التشغيل", "تدهور الخدمة"],
-            "تجربة العميل": ["تجربة رقمية سيئة", "عدم اتساق القنوات", "مشاكل إمكانية الوصول", "تأخر وقت الاستجابة", "كشف بيانات العميل"],
-            "التوافق الاستراتيجي": ["أهداف غير متوافقة", "عدم يقين العائد", "زحف النطاق", "تعارض الأولويات", "قيود الموارد"],
-            "المورد والسحابة": ["الاعتماد على المورد", "انقطاع الخدمة السحابية", "مشاكل العقود", "تجاوز التكاليف", "انتهاكات SLA"],
-            "الأمن في التحول": ["فجوات أمنية أثناء الترحيل", "أسطح هجوم جديدة", "مشاكل التحكم بالوصول", "كشف البيانات", "فجوات الامتثال"]
-        }
-    },
-    "global": {
-        "en": {
-            "Strategic Risk": ["Market changes", "Competitive disruption", "Regulatory changes", "Technology obsolescence", "Geopolitical factors"],
-            "Operational Risk": ["Process failures", "System outages", "Human errors", "Resource constraints", "Supplier disruptions"],
-            "Financial Risk": ["Budget overruns", "Cost escalation", "Revenue impact", "Investment loss", "Currency fluctuation"],
-            "Compliance Risk": ["Regulatory violations", "Audit findings", "Certification loss", "Legal penalties", "Reporting failures"],
-            "Reputational Risk": ["Brand damage", "Customer trust loss", "Media exposure", "Stakeholder concerns", "Social media crisis"],
-            "Business Continuity": ["Natural disasters", "Pandemic impact", "Infrastructure failure", "Key person dependency", "Supply chain disruption"],
-            "Information Security": ["Data breaches", "Cyber attacks", "Insider threats", "Third-party risks", "Physical security"],
-            "Quality Risk": ["Product defects", "Service failures", "Customer complaints", "Non-conformance", "Continuous improvement gaps"]
-        },
-        "ar": {
-            "المخاطر الاستراتيجية": ["تغيرات السوق", "التعطيل التنافسي", "التغييرات التنظيمية", "تقادم التقنية", "العوامل الجيوسياسية"],
-            "المخاطر التشغيلية": ["فشل العمليات", "انقطاع الأنظمة", "الأخطاء البشرية", "قيود الموارد", "اضطرابات الموردين"],
-            "المخاطر المالية": ["تجاوز الميزانية", "تصاعد التكاليف", "تأثير الإيرادات", "خسارة الاستثمار", "تقلب العملة"],
-            "مخاطر الامتثال": ["انتهاكات تنظيمية", "نتائج التدقيق", "فقدان الشهادات", "العقوبات القانونية", "فشل التقارير"],
-            "مخاطر السمعة": ["ضرر العلامة التجارية", "فقدان ثقة العميل", "التعرض الإعلامي", "مخاوف أصحاب المصلحة", "أزمة وسائل التواصل"],
-            "استمرارية الأعمال": ["الكوارث الطبيعية", "تأثير الجائحة", "فشل البنية التحتية", "الاعتماد على أشخاص رئيسيين", "تعطل سلسلة التوريد"],
-            "أمن المعلومات": ["خروقات البيانات", "الهجمات السيبرانية", "التهديدات الداخلية", "مخاطر الأطراف الثالثة", "الأمن المادي"],
-            "مخاطر الجودة": ["عيوب المنتج", "فشل الخدمة", "شكاوى العملاء", "عدم المطابقة", "فجوات التحسين المستمر"]
-        }
-    }
-}
-
-DOMAIN_CODES = {
-    "Cyber Security": "cyber",
-    "Data Management": "data", 
-    "Artificial Intelligence": "ai",
-    "Digital Transformation": "dt",
-    "Global Standards": "global",
-    "الأمن السيبراني": "cyber",
-    "إدارة البيانات": "data",
-    "الذكاء الاصطناعي": "ai",
-    "التحول الرقمي": "dt",
-    "المعايير العالمية": "global"
-}
+# Domain codes in the same order as the "domains" list of every locale file
+DOMAIN_CODE_ORDER = ('cyber', 'data', 'ai', 'dt', 'global')
+
+DOMAIN_FRAMEWORKS = freeze_tree(DOMAIN_FRAMEWORKS, 1)
+
+def normalize_domain_name(name):
+    """Normalize a domain display name so pasted Arabic presentation forms still match."""
+    return unicodedata.normalize('NFKC', name).strip().casefold()
+
+@lru_cache(maxsize=1)
+def get_domain_codes():
+    """Map normalized domain names in every language to their domain code."""
+    return MappingProxyType({
+        normalize_domain_name(name): code
+        for lang in SUPPORTED_LANGUAGES
+        for code, name in zip(DOMAIN_CODE_ORDER, get_text(lang)['domains'])
+    })
+
+def get_domain_code(domain_name, default='global'):
+    """Get the domain code for a display name in any supported language."""
+    return get_domain_codes().get(normalize_domain_name(domain_name), default)
+
+# Prebuilt sets so form validation is a hash probe instead of a list scan
+DOMAIN_FRAMEWORK_SETS = MappingProxyType({code: frozenset(items) for code, items in DOMAIN_FRAMEWORKS.items()})
+ALL_FRAMEWORKS = frozenset().union(*DOMAIN_FRAMEWORK_SETS.values())
+
+@lru_cache(maxsize=1)
+def get_sector_set():
+    """Get every sector label accepted from forms, in all supported languages."""
+    return frozenset(sector for lang in SUPPORTED_LANGUAGES for sector in get_text(lang)['sectors'])
+
+def is_valid_selection(domain_name, sector=None, frameworks=()):
+    """Check a submitted sector and frameworks against the domain's allowed values."""
+    # JSON bodies can carry any type; anything but strings would break the set lookups below
+    if not isinstance(domain_name, (str, type(None))) or not isinstance(sector, (str, type(None))):
+        return False
+    if not isinstance(frameworks, (list, tuple)) or not all(isinstance(f, str) for f in frameworks):
+        return False
+    if sector is not None and sector not in get_sector_set():
+        return False
+    allowed = DOMAIN_FRAMEWORK_SETS.get(get_domain_code(domain_name or '', None), ALL_FRAMEWORKS)
+    return allowed.issuperset(frameworks)
+
+@lru_cache(maxsize=16)
+def get_domain_data(domain_code, lang='en'):
+    """Load technologies and risk categories (locales/domains/<code>.<lang>.json)."""
+    if domain_code not in DOMAIN_FRAMEWORKS or lang not in SUPPORTED_LANGUAGES:
+        return MappingProxyType({})
+    data = load_locale_file('domains', f'{domain_code}.{lang}.json')
+    return MappingProxyType({
+        'technologies': freeze_tree(data['technologies'], 1),
+        'risk_categories': freeze_tree(data['risk_categories'], 1),
+        # Serialized once here instead of running |tojson on every domain page render
+        'risk_categories_json': htmlsafe_json_dumps(data['risk_categories'], dumps=app.json.dumps)
+    })
 
 # ============================================================================
 # AI SERVICE
 # ============================================================================
 
+# One client per process: it is thread-safe and keeps its HTTPS connection
+# pool alive across requests. The openai SDK is by far the slowest import here,
+# so deployments without a key never load it
+if config.OPENAI_API_KEY:
+    import openai
+    openai_client = openai.OpenAI(api_key=config.OPENAI_API_KEY)
+else:
+    openai_client = None
+
+# The API key cannot change while the process runs, so availability is fixed at import
+AI_AVAILABLE = openai_client is not None
+
 def check_ai_available():
     """Check if OpenAI API is available."""
-    return bool(config.OPENAI_API_KEY)
+    return AI_AVAILABLE
+
+class AIThrottle:
+    """Admission control for OpenAI calls: caps calls in flight and meters starts with a token bucket."""
+    
+    def __init__(self, max_rpm, max_concurrent):
+        self._slots = threading.BoundedSemaphore(max_concurrent)
+        self._lock = threading.Lock()
+        self._rate = max_rpm / 60.0
+        self._capacity = float(max_concurrent)
+        self._tokens = self._capacity
+        self._updated = time.monotonic()
+    
+    def _refill(self, now):
+        self._tokens = min(self._capacity, self._tokens + (now - self._updated) * self._rate)
+        self._updated = now
+    
+    def __enter__(self):
+        self._slots.acquire()
+        with self._lock:
+            self._refill(time.monotonic())
+            # Taking the token up front reserves this call's place when the bucket is empty
+            self._tokens -= 1
+            wait = -self._tokens / self._rate if self._tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
+        return self
+    
+    def __exit__(self, *exc_info):
+        self._slots.release()
+    
+    def back_off(self, seconds):
+        """Hold every new call back for `seconds` after the API answers 429."""
+        with self._lock:
+            self._refill(time.monotonic())
+            self._tokens = min(self._tokens, -seconds * self._rate)
+
+ai_throttle = AIThrottle(config.OPENAI_MAX_RPM / config.WEB_CONCURRENCY, config.OPENAI_MAX_CONCURRENCY)
+
+def get_retry_after(error, default=1.0):
+    """Read the Retry-After delay (seconds) from a rate limit error."""
+    try:
+        return float(error.response.headers.get('retry-after', default))
+    except (AttributeError, TypeError, ValueError):
+        return default
+
+# Shared by requests that fan out several independent completions (e.g. strategy sections)
+ai_pool = ThreadPoolExecutor(max_workers=config.AI_WORKERS, thread_name_prefix='ai')
+
+def request_ai_content(prompt, language='en', context=None):
+    """Run a single chat completion; API errors propagate to the caller.
+    
+    `context` is appended to the system message, so calls sharing it only differ in `prompt`.
+    """
+    system_prompt = "You are an expert GRC consultant. Provide professional, detailed responses."
+    if language == 'ar':
+        system_prompt = "أنت مستشار خبير في الحوكمة والمخاطر والامتثال. قدم ردوداً مهنية ومفصلة باللغة العربية."
+    if context:
+        system_prompt = f"{system_prompt}\n\n{context}"
+    
+    with ai_throttle:
+        try:
+            response = openai_client.chat.completions.create(
+                model="gpt-4-turbo",
+                messages=[
+                    {"role": "system", "content": system_prompt},
+                    {"role": "user", "content": prompt}
+                ],
+                max_tokens=4000,
+                temperature=0.7
+            )
+        except openai.RateLimitError as e:
+            ai_throttle.back_off(get_retry_after(e))
+            raise
+    
+    return response.choices[0].message.content
 
 def generate_ai_content(prompt, language='en'):
     """Generate content using OpenAI API."""
-    if not config.OPENAI_API_KEY:
+    if openai_client is None:
         return generate_simulation_content(prompt, language)
     
     try:
-        import openai
-        client = openai.OpenAI(api_key=config.OPENAI_API_KEY)
-        
-        system_prompt = "You are an expert GRC consultant. Provide professional, detailed responses."
-        if language == 'ar':
-            system_prompt = "أنت مستشار خبير في الحوكمة والمخاطر والامتثال. قدم ردوداً مهنية ومفصلة باللغة العربية."
-        
-        response = client.chat.completions.create(
-            model="gpt-4-turbo",
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": prompt}
-            ],
-            max_tokens=4000,
-            temperature=0.7
-        )
-        
-        return response.choices[0].message.content
+        return request_ai_content(prompt, language)
     except Exception as e:
         print(f"AI Error: {e}")
         return generate_simulation_content(prompt, language)
 
+def generate_ai_contents(prompts, fallbacks, language='en', context=None):
+    """Generate several independent prompts concurrently; returns None if AI is unavailable.
+    
+    A prompt whose call fails (or comes back empty) is replaced by its entry in `fallbacks`,
+    so one failure keeps the completions already paid for.
+    """
+    if openai_client is None:
+        return None
+    
+    futures = [ai_pool.submit(request_ai_content, prompt, language, context) for prompt in prompts]
+    results = []
+    for i, future in enumerate(futures):
+        try:
+            content = future.result()
+        except Exception as e:
+            print(f"AI Error: {e}")
+            content = None
+        if not content:
+            content = fallbacks[i]
+        results.append(content)
+    return results
+
+def simulated_strategy_sections(language='en'):
+    """Simulated strategy content split into its six sections, in document order."""
+    return [part.strip() for part in generate_strategy_simulation(language).split('[SECTION]')]
+
 def generate_simulation_content(prompt, language='en'):
     """Generate simulated content when AI is unavailable - detects content type from prompt."""
     prompt_lower = prompt.lower()
@@ -1190,6 +1333,65 @@ The identified threat poses a significant risk to data confidentiality and integ
 **Assessment Date:** [To be added]
 **Next Review:** Within 6 months"""
 
+# ============================================================================
+# PAGE CACHING
+# ============================================================================
+
+cache = Cache(app, config={'CACHE_TYPE': 'SimpleCache', 'CACHE_DEFAULT_TIMEOUT': 300})
+
+def render_page(template_name, **context):
+    """Render a read-only page, reusing cached HTML per path, language and user."""
+    # Pending flash messages make the output one-off; render those normally
+    if '_flashes' in session:
+        return render_template(template_name, **context)
+    # request.path, not full_path: no cached view reads the query string (lang comes from context),
+    # so arbitrary query strings must not mint new entries and evict real pages
+    key = f"page:{template_name}:{request.path}:{context.get('lang')}:{g.get('user_id', '')}"
+    html = cache.get(key)
+    if html is None:
+        html = render_template(template_name, **context)
+        cache.set(key, html)
+    return html
+
+@app.after_request
+def add_etag(response):
+    """Tag GET responses with a content hash and answer matching If-None-Match with 304."""
+    if request.method == 'GET' and response.status_code == 200 and not response.direct_passthrough:
+        response.set_etag(hashlib.blake2s(response.get_data()).hexdigest())
+        response.make_conditional(request)
+    return response
+
+# Static assets (main.css, rtl.css, main.js) carry a content hash in their URL,
+# so browsers may keep them for a year and only refetch after they change
+STATIC_MAX_AGE = int(timedelta(days=365).total_seconds())
+
+@lru_cache(maxsize=32)
+def static_version(filename):
+    """Short content hash of a static file, computed once per process."""
+    try:
+        with open(os.path.join(app.static_folder, filename), 'rb') as f:
+            return hashlib.blake2s(f.read(), digest_size=6).hexdigest()
+    except OSError:
+        return None
+
+@app.url_defaults
+def add_static_version(endpoint, values):
+    """Append ?v=<hash> to url_for('static', ...) links for cache busting."""
+    if endpoint == 'static' and 'filename' in values:
+        version = static_version(values['filename'])
+        if version:
+            values.setdefault('v', version)
+
+@app.after_request
+def cache_versioned_static(response):
+    """Let browsers keep content-hashed static files for a year."""
+    # Only static URLs carrying ?v= qualify; other send_file responses keep Flask's no-cache default
+    if request.endpoint == 'static' and 'v' in request.args:
+        response.cache_control.no_cache = None
+        response.cache_control.public = True
+        response.cache_control.max_age = STATIC_MAX_AGE
+    return response
+
 # ============================================================================
 # ROUTES - AUTHENTICATION
 # ============================================================================
@@ -1204,41 +1406,57 @@ def index():
 @app.route('/login', methods=['GET', 'POST'])
 def login():
     """Login page."""
-    lang = request.args.get('lang', session.get('lang', 'en'))
-    session['lang'] = lang
-    txt = get_text(lang)
+    lang, txt, is_rtl = g.lang, g.txt, g.is_rtl
     
     if request.method == 'POST':
         username = request.form.get('username', '').strip()
         password = request.form.get('password', '')
         
+        # register() never accepts credentials outside these bounds, so they cannot match;
+        # reject them before the user lookup and the KDF run
+        if (len(username) < config.MIN_USERNAME_LENGTH
+                or not config.MIN_PASSWORD_LENGTH <= len(password) <= config.MAX_PASSWORD_LENGTH):
+            flash('Invalid username or password', 'error')
+            return render_page('login.html', txt=txt, lang=lang, config=config, is_rtl=is_rtl)
+        
+        # Release the connection before the KDF runs, so logins waiting on Argon2 do not hold the pool
         conn = get_db()
-        user = conn.execute('SELECT * FROM users WHERE username = ?', (username,)).fetchone()
+        user = conn.execute(SELECT_LOGIN_USER_SQL, (username,)).fetchone()
         conn.close()
         
-        if user and verify_password(password, user['password_hash']):
+        # Unknown usernames are checked against a dummy hash, so they cost as much
+        # as a wrong password and response timing does not reveal which accounts exist
+        stored_hash = user['password_hash'] if user else get_dummy_hash()
+        if verify_password(password, stored_hash) and user:
+            # Transparently migrate legacy PBKDF2 / outdated Argon2 hashes
+            if needs_rehash(user['password_hash']):
+                queue_db_write(UPDATE_PASSWORD_HASH_SQL, (hash_password(password), user['id']))
             session.permanent = True
             session['user_id'] = user['id']
-            session['username'] = user['username']
+            # Profile fields views display are kept in the session so no request has to query users
+            session['user_meta'] = {'id': user['id'], 'username': user['username'],
+                                    'created_at': user['created_at']}
             return redirect(url_for('dashboard'))
         else:
             flash('Invalid username or password', 'error')
     
-    return render_template('login.html', 
-                          txt=txt, 
-                          lang=lang, 
-                          config=config,
-                          is_rtl=(lang == 'ar'))
+    return render_page('login.html', 
+                      txt=txt, 
+                      lang=lang, 
+                      config=config,
+                      is_rtl=is_rtl)
 
 @app.route('/register', methods=['POST'])
 def register():
     """Register new user."""
-    lang = session.get('lang', 'en')
+    lang = g.lang
     username = request.form.get('username', '').strip()
     password = request.form.get('password', '')
     
-    if len(username) < 3 or len(password) < 6:
-        flash('Username must be 3+ chars, password 6+ chars', 'error')
+    if (len(username) < config.MIN_USERNAME_LENGTH
+            or not config.MIN_PASSWORD_LENGTH <= len(password) <= config.MAX_PASSWORD_LENGTH):
+        flash(f'Username must be {config.MIN_USERNAME_LENGTH}+ chars, '
+              f'password {config.MIN_PASSWORD_LENGTH}-{config.MAX_PASSWORD_LENGTH} chars', 'error')
         return redirect(url_for('login', lang=lang))
     
     conn = get_db()
@@ -1257,7 +1475,7 @@ def register():
 @app.route('/logout')
 def logout():
     """Logout user."""
-    lang = session.get('lang', 'en')
+    lang = g.lang
     session.clear()
     session['lang'] = lang
     return redirect(url_for('login', lang=lang))
@@ -1270,32 +1488,21 @@ def logout():
 @login_required
 def dashboard():
     """Main dashboard."""
-    lang = request.args.get('lang', session.get('lang', 'en'))
-    session['lang'] = lang
-    txt = get_text(lang)
+    lang, txt, is_rtl = g.lang, g.txt, g.is_rtl
     
     # Get user stats
     conn = get_db()
-    strategies_count = conn.execute(
-        'SELECT COUNT(*) FROM strategies WHERE user_id = ?', 
-        (session['user_id'],)
-    ).fetchone()[0]
-    policies_count = conn.execute(
-        'SELECT COUNT(*) FROM policies WHERE user_id = ?',
-        (session['user_id'],)
-    ).fetchone()[0]
-    risks_count = conn.execute(
-        'SELECT COUNT(*) FROM risks WHERE user_id = ?',
-        (session['user_id'],)
-    ).fetchone()[0]
+    strategies_count, policies_count, risks_count = conn.execute(
+        DASHBOARD_COUNTS_SQL, {'user_id': g.user_id}
+    ).fetchone()
     conn.close()
     
     return render_template('dashboard.html',
                           txt=txt,
                           lang=lang,
                           config=config,
-                          is_rtl=(lang == 'ar'),
-                          username=session.get('username'),
+                          is_rtl=is_rtl,
+                          username=g.user_meta['username'],
                           ai_available=check_ai_available(),
                           stats={
                               'strategies': strategies_count,
@@ -1303,87 +1510,116 @@ def dashboard():
                               'risks': risks_count
                           },
                           domains=txt['domains'],
-                          domain_codes=DOMAIN_CODES,
                           frameworks=DOMAIN_FRAMEWORKS)
 
 @app.route('/domain/<domain_name>')
 @login_required
 def domain_page(domain_name):
     """Domain-specific page."""
-    lang = request.args.get('lang', session.get('lang', 'en'))
-    session['lang'] = lang
-    txt = get_text(lang)
+    lang, txt, is_rtl = g.lang, g.txt, g.is_rtl
     
-    domain_code = DOMAIN_CODES.get(domain_name, 'global')
+    domain_code = get_domain_code(domain_name)
     frameworks = DOMAIN_FRAMEWORKS.get(domain_code, [])
     
-    # Get domain-specific technologies
-    lang_key = 'ar' if lang == 'ar' else 'en'
-    technologies = DOMAIN_TECHNOLOGIES.get(domain_code, {}).get(lang_key, {})
-    
-    # Get risk categories with scenarios
-    risk_data = RISK_CATEGORIES.get(domain_code, {}).get(lang_key, {})
+    # Technologies and risk scenarios come from one cached lookup per (domain, language)
+    domain_data = get_domain_data(domain_code, 'ar' if lang == 'ar' else 'en')
     
-    return render_template('domain.html',
-                          txt=txt,
-                          lang=lang,
-                          config=config,
-                          is_rtl=(lang == 'ar'),
-                          username=session.get('username'),
-                          ai_available=check_ai_available(),
-                          domain_name=domain_name,
-                          domain_code=domain_code,
-                          frameworks=frameworks,
-                          technologies=technologies,
-                          risk_categories=risk_data)
+    return render_page('domain.html',
+                      txt=txt,
+                      lang=lang,
+                      config=config,
+                      is_rtl=is_rtl,
+                      username=g.user_meta['username'],
+                      ai_available=check_ai_available(),
+                      domain_name=domain_name,
+                      domain_code=domain_code,
+                      frameworks=frameworks,
+                      technologies=domain_data['technologies'],
+                      risk_categories=domain_data['risk_categories'],
+                      risk_categories_json=domain_data['risk_categories_json'])
 
 # ============================================================================
 # ROUTES - API ENDPOINTS
 # ============================================================================
 
-@app.route('/api/generate-strategy', methods=['POST'])
-@login_required
-def api_generate_strategy():
-    """Generate strategy via AI."""
-    try:
-        data = request.json
-        lang = data.get('language', 'en')
-        
-        # Get current state info
-        org_structure = data.get('org_structure', 'Not specified')
-        technologies = data.get('technologies', [])
-        maturity = data.get('maturity_level', 'initial')
-        tech_list = ', '.join(technologies) if technologies else 'None specified'
-        frameworks_list = ', '.join(data.get('frameworks', [])) if data.get('frameworks') else 'Not specified'
-        
-        if lang == 'ar':
-            prompt = f"""أنت خبير في الحوكمة والمخاطر والامتثال. أنشئ وثيقة استراتيجية احترافية بتنسيق Markdown.
+# Bare numbered section header in AI output, e.g. "1. Vision & Objectives"
+NUMBERED_SECTION_RE = re.compile(r'^[1-6]\.\s+\w')
 
-ملاحظة مهمة: التاريخ الحالي هو 2026. استخدم تواريخ مستقبلية (2027، 2028، 2029) أو نسبية (السنة 1، السنة 2، خلال 12 شهر).
+# Strategy sections in document order, with the output format the AI must follow for each
+STRATEGY_SECTIONS = ('vision', 'gaps', 'pillars', 'roadmap', 'kpis', 'confidence')
 
-معلومات المنظمة:
-- الاسم: {data.get('org_name', 'المنظمة')}
-- القطاع: {data.get('sector', 'عام')}
-- المجال: {data.get('domain', 'الأمن السيبراني')}
-- الحجم: {data.get('size', 'متوسط')}
-- الميزانية: {data.get('budget', '1-5 مليون')}
-- الأطر التنظيمية: {frameworks_list}
-- الهيكل الحالي: {org_structure}
-- التقنيات المطبقة: {tech_list}
-- مستوى النضج: {maturity}
-- التحديات: {data.get('challenges', 'غير محدد')}
+STRATEGY_SECTION_FORMATS = {
+    'en': (
+        """## 1. Vision & Objectives
 
-اكتب 6 أقسام منفصلة. استخدم [SECTION] كفاصل بين كل قسم.
+**Vision:**
+[One paragraph describing the strategic vision]
 
-قواعد التنسيق الصارمة - يجب اتباعها بالضبط:
-1. استخدم ## للعناوين الرئيسية فقط
-2. استخدم ### للعناوين الفرعية قبل كل جدول
-3. كل جدول يجب أن يسبقه عنوان ### 
-4. استخدم النقاط (•) للمبادرات تحت الركائز فقط
+### Strategic Objectives:
+| # | Objective | Target Metric | Timeframe |
+|---|-----------|---------------|-----------|
+| 1 | [Objective] | [Metric] | Within X months |
+| 2 | [Objective] | [Metric] | Within X months |
+(5-7 objectives)""",
+        """## 2. Gap Analysis
+
+### Identified Gaps:
+| # | Gap | Description | Priority |
+|---|-----|-------------|----------|
+| 1 | [Gap name] | [Detailed description] | High |
+(4-5 gaps)""",
+        """## 3. Strategic Pillars
+
+### Pillar 1: [Name]
+• Initiative one
+• Initiative two
+
+### Pillar 2: [Name]
+• Initiative one
+• Initiative two
+
+### Pillar 3: [Name]
+• Initiative one
+• Initiative two
+
+### Pillar 4: [Name]
+• Initiative one
+• Initiative two""",
+        """## 4. Implementation Roadmap
+
+### Phase 1 (0-6 months)
+| # | Activity | Owner | Timeline |
+|---|----------|-------|----------|
+| 1 | [Activity] | [Owner] | Month X |
+
+### Phase 2 (6-12 months)
+| # | Activity | Owner | Timeline |
+|---|----------|-------|----------|
+| 1 | [Activity] | [Owner] | Month X |
+
+### Phase 3 (12-24 months)
+| # | Activity | Owner | Timeline |
+|---|----------|-------|----------|
+| 1 | [Activity] | [Owner] | Month X |""",
+        """## 5. Key Performance Indicators
 
-اتبع هذا التنسيق بالضبط:
+### KPIs:
+| # | KPI | Current Value | Target Value | Timeframe |
+|---|-----|---------------|--------------|-----------|
+| 1 | [KPI] | [Value] | [Value] | Within X months |
+(8-10 KPIs)""",
+        """## 6. Confidence Assessment & Risks
 
-## 1. الرؤية والأهداف
+**Confidence Score:** [X]% - [Brief justification]
+
+### Key Risks:
+| # | Risk | Likelihood | Impact | Mitigation Plan |
+|---|------|------------|--------|-----------------|
+| 1 | [Risk] | High/Medium/Low | High/Medium/Low | [Action] |
+(4-5 risks)""",
+    ),
+    'ar': (
+        """## 1. الرؤية والأهداف
 
 **الرؤية:**
 [فقرة واحدة تصف الرؤية الاستراتيجية]
@@ -1393,21 +1629,15 @@ def api_generate_strategy():
 |---|-------|----------------|---------------|
 | 1 | [الهدف] | [المؤشر] | خلال X شهر |
 | 2 | [الهدف] | [المؤشر] | خلال X شهر |
-(5-7 أهداف)
-
-[SECTION]
-
-## 2. تحليل الفجوات
+(5-7 أهداف)""",
+        """## 2. تحليل الفجوات
 
 ### الفجوات المحددة:
 | # | الفجوة | الوصف | الأولوية |
 |---|--------|-------|----------|
 | 1 | [اسم الفجوة] | [وصف تفصيلي] | عالية |
-(4-5 فجوات)
-
-[SECTION]
-
-## 3. الركائز الاستراتيجية
+(4-5 فجوات)""",
+        """## 3. الركائز الاستراتيجية
 
 ### الركيزة 1: [الاسم]
 • المبادرة الأولى
@@ -1423,11 +1653,8 @@ def api_generate_strategy():
 
 ### الركيزة 4: [الاسم]
 • المبادرة الأولى
-• المبادرة الثانية
-
-[SECTION]
-
-## 4. خارطة الطريق
+• المبادرة الثانية""",
+        """## 4. خارطة الطريق
 
 ### المرحلة 1 (0-6 أشهر)
 | # | النشاط | المسؤول | الموعد |
@@ -1442,21 +1669,15 @@ def api_generate_strategy():
 ### المرحلة 3 (12-24 شهر)
 | # | النشاط | المسؤول | الموعد |
 |---|--------|---------|--------|
-| 1 | [النشاط] | [المسؤول] | شهر X |
-
-[SECTION]
-
-## 5. مؤشرات الأداء الرئيسية
+| 1 | [النشاط] | [المسؤول] | شهر X |""",
+        """## 5. مؤشرات الأداء الرئيسية
 
 ### المؤشرات:
 | # | المؤشر | القيمة الحالية | القيمة المستهدفة | الإطار الزمني |
 |---|--------|---------------|-----------------|---------------|
 | 1 | [المؤشر] | [القيمة] | [القيمة] | خلال X شهر |
-(8-10 مؤشرات)
-
-[SECTION]
-
-## 6. تقييم الثقة والمخاطر
+(8-10 مؤشرات)""",
+        """## 6. تقييم الثقة والمخاطر
 
 **درجة الثقة:** [X]% - [تبرير قصير]
 
@@ -1464,292 +1685,252 @@ def api_generate_strategy():
 | # | الخطر | الاحتمالية | الأثر | خطة التخفيف |
 |---|-------|-----------|-------|-------------|
 | 1 | [الخطر] | عالية/متوسطة/منخفضة | عالي/متوسط/منخفض | [الإجراء] |
-(4-5 مخاطر)"""
-        else:
-            prompt = f"""You are a GRC expert. Generate a professional strategy document in Markdown format.
-
-IMPORTANT: Current year is 2026. Use FUTURE dates (2027, 2028, 2029) or RELATIVE timeframes (Year 1, Year 2, within 12 months, within 24 months).
-
-Organization Info:
-- Name: {data.get('org_name', 'Organization')}
-- Sector: {data.get('sector', 'General')}
-- Domain: {data.get('domain', 'Cyber Security')}
-- Size: {data.get('size', 'Medium')}
-- Budget: {data.get('budget', '1M-5M')}
-- Frameworks: {frameworks_list}
-- Current Structure: {org_structure}
-- Technologies: {tech_list}
-- Maturity: {maturity}
-- Challenges: {data.get('challenges', 'Not specified')}
-
-Write 6 separate sections. Use [SECTION] as separator between each.
+(4-5 مخاطر)""",
+    ),
+}
 
-STRICT FORMATTING RULES - FOLLOW EXACTLY:
+STRATEGY_FORMATTING_RULES = {
+    'en': """STRICT FORMATTING RULES - FOLLOW EXACTLY:
 1. Use ## for main section headings ONLY
 2. Use ### for subheadings BEFORE every table
 3. Every table MUST be preceded by a ### heading
-4. Use bullet points (•) for initiatives under pillars ONLY
-
-Follow this EXACT format:
-
-## 1. Vision & Objectives
-
-**Vision:**
-[One paragraph describing the strategic vision]
+4. Use bullet points (•) for initiatives under pillars ONLY""",
+    'ar': """قواعد التنسيق الصارمة - يجب اتباعها بالضبط:
+1. استخدم ## للعناوين الرئيسية فقط
+2. استخدم ### للعناوين الفرعية قبل كل جدول
+3. كل جدول يجب أن يسبقه عنوان ### 
+4. استخدم النقاط (•) للمبادرات تحت الركائز فقط""",
+}
 
-### Strategic Objectives:
-| # | Objective | Target Metric | Timeframe |
-|---|-----------|---------------|-----------|
-| 1 | [Objective] | [Metric] | Within X months |
-| 2 | [Objective] | [Metric] | Within X months |
-(5-7 objectives)
+# Prompt instructions for generating all sections in one completion (the separator line
+# goes before the formatting rules, the format line after them), or one section per completion
+STRATEGY_ALL_SECTIONS_PROMPT = {
+    'en': ("Write 6 separate sections. Use [SECTION] as separator between each.", "Follow this EXACT format:"),
+    'ar': ("اكتب 6 أقسام منفصلة. استخدم [SECTION] كفاصل بين كل قسم.", "اتبع هذا التنسيق بالضبط:"),
+}
+# Used by every document generated one section per completion (strategy, audit)
+ONE_SECTION_PROMPT = {
+    'en': "Write ONLY the following section. Follow this EXACT format:",
+    'ar': "اكتب هذا القسم فقط. اتبع هذا التنسيق بالضبط:",
+}
 
-[SECTION]
+def fix_strategy_formatting(text):
+    """Fix markdown formatting - add ### before tables and ## before section headers."""
+    lines = text.split('\n')
+    fixed_lines = []
+    
+    for i, line in enumerate(lines):
+        stripped = line.strip()
+        
+        # Skip empty lines
+        if not stripped:
+            fixed_lines.append(line)
+            continue
+        
+        # Skip if already has ## or ###
+        if stripped.startswith('##'):
+            fixed_lines.append(line)
+            continue
+        
+        # Check if this is a main section header (like "1. Vision & Objectives")
+        if NUMBERED_SECTION_RE.match(stripped):
+            # Add ## before the section number
+            fixed_lines.append('## ' + stripped)
+            continue
+        
+        # Check if this line ends with : and next non-empty line is a table
+        if stripped.endswith(':') and not stripped.startswith('**'):
+            # Look ahead for table
+            next_line_idx = i + 1
+            while next_line_idx < len(lines) and not lines[next_line_idx].strip():
+                next_line_idx += 1
+            
+            if next_line_idx < len(lines):
+                next_line = lines[next_line_idx].strip()
+                # Check if next line is a table header (starts with |)
+                if next_line.startswith('|'):
+                    # This is a table header without ###, add it
+                    fixed_lines.append('### ' + stripped)
+                    continue
+        
+        fixed_lines.append(line)
+    
+    return '\n'.join(fixed_lines)
+
+# Header patterns that identify each strategy section, checked in order (all lowercase)
+STRATEGY_SECTION_PATTERNS = {
+    'vision': (
+        '1. vision', '## 1.', '1.', 'vision & objective', 'vision and objective',
+        '1. الرؤية', '## 1.', 'الرؤية والأهداف'
+    ),
+    'gaps': (
+        '2. gap', '## 2.', '2.', 'gap analysis',
+        '2. تحليل', '## 2.', 'تحليل الفجوات'
+    ),
+    'pillars': (
+        '3. strategic', '## 3.', '3.', 'strategic pillar', 'pillar 1',
+        '3. الركائز', '## 3.', 'الركائز الاستراتيجية'
+    ),
+    'roadmap': (
+        '4. implementation', '## 4.', '4.', 'roadmap', 'phase 1 (0-6',
+        '4. خارطة', '## 4.', 'خارطة الطريق', 'المرحلة 1'
+    ),
+    'kpis': (
+        '5. key performance', '## 5.', '5.', 'kpi', 'key performance indicator',
+        '5. مؤشرات', '## 5.', 'مؤشرات الأداء'
+    ),
+    'confidence': (
+        '6. confidence', '## 6.', '6.', 'confidence assessment', 'confidence score',
+        '6. تقييم الثقة', '## 6.', 'تقييم الثقة', 'درجة الثقة'
+    )
+}
 
-## 2. Gap Analysis
+# Fallback keywords scored when no header pattern matches (all lowercase)
+STRATEGY_SECTION_KEYWORDS = {
+    'vision': ('vision', 'objective', 'mission', 'الرؤية', 'الأهداف'),
+    'gaps': ('gap', 'weakness', 'الفجوة', 'الفجوات'),
+    'pillars': ('pillar', 'initiative', 'الركائز', 'المبادرات'),
+    'roadmap': ('phase', 'roadmap', 'timeline', 'المرحلة', 'خارطة'),
+    'kpis': ('kpi', 'indicator', 'metric', 'مؤشر', 'مؤشرات'),
+    'confidence': ('confidence', 'risk', 'mitigation', 'الثقة', 'المخاطر')
+}
 
-### Identified Gaps:
-| # | Gap | Description | Priority |
-|---|-----|-------------|----------|
-| 1 | [Gap name] | [Detailed description] | High |
-(4-5 gaps)
-
-[SECTION]
-
-## 3. Strategic Pillars
-
-### Pillar 1: [Name]
-• Initiative one
-• Initiative two
-
-### Pillar 2: [Name]
-• Initiative one
-• Initiative two
-
-### Pillar 3: [Name]
-• Initiative one
-• Initiative two
-
-### Pillar 4: [Name]
-• Initiative one
-• Initiative two
-
-[SECTION]
-
-## 4. Implementation Roadmap
-
-### Phase 1 (0-6 months)
-| # | Activity | Owner | Timeline |
-|---|----------|-------|----------|
-| 1 | [Activity] | [Owner] | Month X |
-
-### Phase 2 (6-12 months)
-| # | Activity | Owner | Timeline |
-|---|----------|-------|----------|
-| 1 | [Activity] | [Owner] | Month X |
-
-### Phase 3 (12-24 months)
-| # | Activity | Owner | Timeline |
-|---|----------|-------|----------|
-| 1 | [Activity] | [Owner] | Month X |
-
-[SECTION]
-
-## 5. Key Performance Indicators
+def identify_strategy_section(text):
+    """Identify which strategy section a block of text belongs to."""
+    text_lower = text.lower()[:300]  # Check first 300 chars
+    
+    # First try to match by section number/header pattern
+    for section_type, patterns in STRATEGY_SECTION_PATTERNS.items():
+        for pattern in patterns:
+            if pattern in text_lower:
+                return section_type
+    
+    # Fallback to keyword matching
+    scores = {section_type: sum(1 for kw in keywords if kw in text_lower)
+              for section_type, keywords in STRATEGY_SECTION_KEYWORDS.items()}
+    
+    if max(scores.values()) > 0:
+        return max(scores, key=scores.get)
+    return None
+
+def parse_strategy_sections(content, lang):
+    """Split a single-completion strategy document into its six sections."""
+    # Parse sections - split by separator
+    parts = []
+    
+    if '[SECTION]' in content:
+        parts = content.split('[SECTION]')
+    elif '\n---\n' in content:
+        parts = content.split('\n---\n')
+    elif '---' in content:
+        parts = content.split('---')
+    else:
+        parts = [content]
+    
+    # Clean parts
+    parts = [p.strip() for p in parts if p.strip()]
+    
+    # Apply fix to each part
+    parts = [fix_strategy_formatting(p) for p in parts]
+    
+    # Initialize sections
+    sections = dict.fromkeys(STRATEGY_SECTIONS, '')
+    
+    # Assign parts to sections based on content detection
+    assigned = set()
+    for part in parts:
+        section_type = identify_strategy_section(part)
+        if section_type and section_type not in assigned:
+            sections[section_type] = part.strip()
+            assigned.add(section_type)
+    
+    # If we couldn't identify sections, fall back to order-based assignment
+    if len(assigned) < 3:
+        sections.update(zip(STRATEGY_SECTIONS, map(str.strip, parts)))
+    
+    return sections
 
-### KPIs:
-| # | KPI | Current Value | Target Value | Timeframe |
-|---|-----|---------------|--------------|-----------|
-| 1 | [KPI] | [Value] | [Value] | Within X months |
-(8-10 KPIs)
+@app.route('/api/generate-strategy', methods=['POST'])
+@login_required
+def api_generate_strategy():
+    """Generate strategy via AI."""
+    try:
+        data = request.json
+        lang = data.get('language', 'en')
+        
+        if not is_valid_selection(data.get('domain'), data.get('sector'), data.get('frameworks') or []):
+            return jsonify({'success': False, 'error': 'Invalid sector or framework'}), 400
+        
+        # Get current state info
+        org_structure = data.get('org_structure', 'Not specified')
+        technologies = data.get('technologies', [])
+        maturity = data.get('maturity_level', 'initial')
+        tech_list = ', '.join(technologies) if technologies else 'None specified'
+        frameworks_list = ', '.join(data.get('frameworks', [])) if data.get('frameworks') else 'Not specified'
+        
+        if lang == 'ar':
+            prompt = f"""أنت خبير في الحوكمة والمخاطر والامتثال. أنشئ وثيقة استراتيجية احترافية بتنسيق Markdown.
 
-[SECTION]
+ملاحظة مهمة: التاريخ الحالي هو 2026. استخدم تواريخ مستقبلية (2027، 2028، 2029) أو نسبية (السنة 1، السنة 2، خلال 12 شهر).
 
-## 6. Confidence Assessment & Risks
+معلومات المنظمة:
+- الاسم: {data.get('org_name', 'المنظمة')}
+- القطاع: {data.get('sector', 'عام')}
+- المجال: {data.get('domain', 'الأمن السيبراني')}
+- الحجم: {data.get('size', 'متوسط')}
+- الميزانية: {data.get('budget', '1-5 مليون')}
+- الأطر التنظيمية: {frameworks_list}
+- الهيكل الحالي: {org_structure}
+- التقنيات المطبقة: {tech_list}
+- مستوى النضج: {maturity}
+- التحديات: {data.get('challenges', 'غير محدد')}"""
+        else:
+            prompt = f"""You are a GRC expert. Generate a professional strategy document in Markdown format.
 
-**Confidence Score:** [X]% - [Brief justification]
+IMPORTANT: Current year is 2026. Use FUTURE dates (2027, 2028, 2029) or RELATIVE timeframes (Year 1, Year 2, within 12 months, within 24 months).
 
-### Key Risks:
-| # | Risk | Likelihood | Impact | Mitigation Plan |
-|---|------|------------|--------|-----------------|
-| 1 | [Risk] | High/Medium/Low | High/Medium/Low | [Action] |
-(4-5 risks)"""
+Organization Info:
+- Name: {data.get('org_name', 'Organization')}
+- Sector: {data.get('sector', 'General')}
+- Domain: {data.get('domain', 'Cyber Security')}
+- Size: {data.get('size', 'Medium')}
+- Budget: {data.get('budget', '1M-5M')}
+- Frameworks: {frameworks_list}
+- Current Structure: {org_structure}
+- Technologies: {tech_list}
+- Maturity: {maturity}
+- Challenges: {data.get('challenges', 'Not specified')}"""
 
-        content = generate_ai_content(prompt, lang)
-        
-        import re  # Import at function level to ensure availability
-        
-        # Parse sections - split by separator
-        parts = []
+        prompt_lang = 'ar' if lang == 'ar' else 'en'
+        formats = STRATEGY_SECTION_FORMATS[prompt_lang]
+        rules = STRATEGY_FORMATTING_RULES[prompt_lang]
         
-        if '[SECTION]' in content:
-            parts = content.split('[SECTION]')
-        elif '\n---\n' in content:
-            parts = content.split('\n---\n')
-        elif '---' in content:
-            parts = content.split('---')
+        # With AI available, generate each section in its own completion so the
+        # six calls overlap instead of running back to back. The organization prompt
+        # and formatting rules are shared context; a failed section falls back to
+        # its simulated text instead of discarding the others
+        section_texts = generate_ai_contents(
+            [f"{ONE_SECTION_PROMPT[prompt_lang]}\n\n{fmt}" for fmt in formats],
+            simulated_strategy_sections(lang), lang, context=f"{prompt}\n\n{rules}")
+        if section_texts is not None:
+            section_texts = [fix_strategy_formatting(text.strip()) for text in section_texts]
+            content = '\n\n'.join(section_texts)
+            sections = dict(zip(STRATEGY_SECTIONS, section_texts))
         else:
-            parts = [content]
-        
-        # Clean parts
-        parts = [p.strip() for p in parts if p.strip()]
-        
-        def fix_formatting(text, lang_code):
-            """Fix markdown formatting - add ### before tables and ## before section headers."""
-            import re
-            lines = text.split('\n')
-            fixed_lines = []
-            
-            for i, line in enumerate(lines):
-                stripped = line.strip()
-                
-                # Skip empty lines
-                if not stripped:
-                    fixed_lines.append(line)
-                    continue
-                
-                # Skip if already has ## or ###
-                if stripped.startswith('##'):
-                    fixed_lines.append(line)
-                    continue
-                
-                # Check if this is a main section header (like "1. Vision & Objectives")
-                if re.match(r'^[1-6]\.\s+\w', stripped):
-                    # Add ## before the section number
-                    fixed_lines.append('## ' + stripped)
-                    continue
-                
-                # Check if this line ends with : and next non-empty line is a table
-                if stripped.endswith(':') and not stripped.startswith('**'):
-                    # Look ahead for table
-                    next_line_idx = i + 1
-                    while next_line_idx < len(lines) and not lines[next_line_idx].strip():
-                        next_line_idx += 1
-                    
-                    if next_line_idx < len(lines):
-                        next_line = lines[next_line_idx].strip()
-                        # Check if next line is a table header (starts with |)
-                        if next_line.startswith('|'):
-                            # This is a table header without ###, add it
-                            fixed_lines.append('### ' + stripped)
-                            continue
-                
-                fixed_lines.append(line)
-            
-            return '\n'.join(fixed_lines)
-        
-        # Apply fix to each part
-        print("=" * 60)
-        print("BEFORE fix_formatting - First part preview:")
-        if parts:
-            print(parts[0][:150])
-        print("=" * 60)
-        
-        parts = [fix_formatting(p, lang) for p in parts]
-        
-        print("AFTER fix_formatting - First part preview:")
-        if parts:
-            print(parts[0][:150])
-        print("=" * 60)
-        
-        # Section header patterns to identify each section
-        section_patterns = {
-            'vision': [
-                '1. vision', '## 1.', '1.', 'vision & objective', 'vision and objective',
-                '1. الرؤية', '## 1.', 'الرؤية والأهداف'
-            ],
-            'gaps': [
-                '2. gap', '## 2.', '2.', 'gap analysis',
-                '2. تحليل', '## 2.', 'تحليل الفجوات'
-            ],
-            'pillars': [
-                '3. strategic', '## 3.', '3.', 'strategic pillar', 'pillar 1',
-                '3. الركائز', '## 3.', 'الركائز الاستراتيجية'
-            ],
-            'roadmap': [
-                '4. implementation', '## 4.', '4.', 'roadmap', 'phase 1 (0-6',
-                '4. خارطة', '## 4.', 'خارطة الطريق', 'المرحلة 1'
-            ],
-            'kpis': [
-                '5. key performance', '## 5.', '5.', 'kpi', 'key performance indicator',
-                '5. مؤشرات', '## 5.', 'مؤشرات الأداء'
-            ],
-            'confidence': [
-                '6. confidence', '## 6.', '6.', 'confidence assessment', 'confidence score',
-                '6. تقييم الثقة', '## 6.', 'تقييم الثقة', 'درجة الثقة'
-            ]
-        }
-        
-        def identify_section(text, lang_code):
-            """Identify which section type this text belongs to."""
-            text_lower = text.lower()[:300]  # Check first 300 chars
-            
-            # First try to match by section number/header pattern
-            for section_type, patterns in section_patterns.items():
-                for pattern in patterns:
-                    if pattern.lower() in text_lower:
-                        return section_type
-            
-            # Fallback to keyword matching
-            keyword_scores = {
-                'vision': ['vision', 'objective', 'mission', 'الرؤية', 'الأهداف'],
-                'gaps': ['gap', 'weakness', 'الفجوة', 'الفجوات'],
-                'pillars': ['pillar', 'initiative', 'الركائز', 'المبادرات'],
-                'roadmap': ['phase', 'roadmap', 'timeline', 'المرحلة', 'خارطة'],
-                'kpis': ['kpi', 'indicator', 'metric', 'مؤشر', 'مؤشرات'],
-                'confidence': ['confidence', 'risk', 'mitigation', 'الثقة', 'المخاطر']
-            }
-            
-            scores = {}
-            for section_type, keywords in keyword_scores.items():
-                score = sum(1 for kw in keywords if kw.lower() in text_lower)
-                scores[section_type] = score
-            
-            if max(scores.values()) > 0:
-                return max(scores, key=scores.get)
-            return None
-        
-        # Initialize sections
-        sections = {
-            'vision': '',
-            'gaps': '',
-            'pillars': '',
-            'roadmap': '',
-            'kpis': '',
-            'confidence': ''
-        }
-        
-        # Assign parts to sections based on content detection
-        assigned = set()
-        for part in parts:
-            section_type = identify_section(part, lang)
-            if section_type and section_type not in assigned:
-                sections[section_type] = part.strip()
-                assigned.add(section_type)
-        
-        # If we couldn't identify sections, fall back to order-based assignment
-        if len(assigned) < 3:
-            section_order = ['vision', 'gaps', 'pillars', 'roadmap', 'kpis', 'confidence']
-            for i, part in enumerate(parts[:6]):
-                if i < len(section_order):
-                    sections[section_order[i]] = part.strip()
+            separator_line, format_line = STRATEGY_ALL_SECTIONS_PROMPT[prompt_lang]
+            content = generate_ai_content(
+                f"{prompt}\n\n{separator_line}\n\n{rules}\n\n{format_line}\n\n"
+                + '\n\n[SECTION]\n\n'.join(formats), lang)
+            sections = parse_strategy_sections(content, lang)
         
         # Save to database
-        try:
-            conn = get_db()
-            conn.execute('''INSERT INTO strategies (user_id, domain, org_name, sector, content, language)
-                            VALUES (?, ?, ?, ?, ?, ?)''',
-                        (session['user_id'], data.get('domain'), data.get('org_name'), 
-                         data.get('sector'), content, lang))
-            conn.commit()
-            conn.close()
-        except Exception as db_error:
-            print(f"Database error: {db_error}")
+        queue_db_write(INSERT_STRATEGY_SQL,
+                       (g.user_id, data.get('domain'), data.get('org_name'),
+                        data.get('sector'), content, lang))
         
         return jsonify({
             'success': True,
-            'sections': sections,
-            'debug_vision_preview': sections.get('vision', '')[:200] if sections.get('vision') else 'EMPTY'
+            'sections': sections
         })
         
     except Exception as e:
@@ -1766,6 +1947,9 @@ def api_generate_policy():
     data = request.json
     lang = data.get('language', 'en')
     
+    if data.get('framework') is not None and not is_valid_selection(data.get('domain'), frameworks=[data['framework']]):
+        return jsonify({'success': False, 'error': 'Invalid framework'}), 400
+    
     if lang == 'ar':
         prompt = f"""أنشئ وثيقة سياسة {data.get('policy_name', 'أمن المعلومات')} احترافية بتنسيق Markdown بناءً على {data.get('framework', 'ISO 27001')}.
 
@@ -1852,13 +2036,9 @@ This policy applies to:
     content = generate_ai_content(prompt, lang)
     
     # Save to database
-    conn = get_db()
-    conn.execute('''INSERT INTO policies (user_id, domain, policy_name, framework, content, language)
-                    VALUES (?, ?, ?, ?, ?, ?)''',
-                (session['user_id'], data.get('domain'), data.get('policy_name'),
-                 data.get('framework'), content, lang))
-    conn.commit()
-    conn.close()
+    queue_db_write(INSERT_POLICY_SQL,
+                   (g.user_id, data.get('domain'), data.get('policy_name'),
+                    data.get('framework'), content, lang))
     
     return jsonify({'success': True, 'content': content})
 
@@ -1983,59 +2163,24 @@ Description of threat and potential sources
     content = generate_ai_content(prompt, lang)
     
     # Save to database
-    conn = get_db()
-    conn.execute('''INSERT INTO risks (user_id, domain, asset_name, threat, risk_level, analysis)
-                    VALUES (?, ?, ?, ?, ?, ?)''',
-                (session['user_id'], data.get('domain'), data.get('asset'),
-                 data.get('threat'), 'HIGH', content))
-    conn.commit()
-    conn.close()
+    queue_db_write(INSERT_RISK_SQL,
+                   (g.user_id, data.get('domain'), data.get('asset'),
+                    data.get('threat'), 'HIGH', content))
     
     return jsonify({'success': True, 'analysis': content})
 
-@app.route('/api/generate-audit', methods=['POST'])
-@login_required
-def api_generate_audit():
-    """Generate audit report."""
-    lang = request.form.get('language', 'en')
-    framework = request.form.get('framework', 'ISO 27001')
-    audit_scope = request.form.get('audit_scope', 'full')
-    domain = request.form.get('domain', 'Cyber Security')
-    
-    # Handle file upload
-    evidence_files = request.files.getlist('evidence')
-    evidence_info = []
-    for f in evidence_files:
-        if f and f.filename:
-            evidence_info.append(f.filename)
-    
-    prompt = f"""Generate a comprehensive audit report in professional Markdown format for:
-Framework: {framework}
-Scope: {audit_scope}
-Domain: {domain}
-Evidence Documents: {', '.join(evidence_info) if evidence_info else 'No evidence provided'}
-
-STRICT AND IMPORTANT INSTRUCTIONS:
-1. Do NOT use any specific dates (like 2024, 2025, January, February, etc.)
-2. Do NOT use any person names or auditor names
-3. Use ONLY relative timeframes like: "Within 30 days", "Within 60 days", "Within 90 days"
-4. For dates use: [To be added]
-5. For audit period use: [Audit Period]
-
-Use the following format:
-
-# Audit Report
+# Audit report parts in document order, with the output format the AI must follow for each
+AUDIT_SECTION_FORMATS = {
+    'en': (
+        """# Audit Report
 
 ## Executive Summary
-Brief overview of audit results with overall compliance percentage
-
-## Audit Scope
-- List of areas covered
-
-## Audit Methodology
-1. Numbered methodology steps
-
-## Findings & Observations
+Brief overview of audit results with overall compliance percentage""",
+        """## Audit Scope
+- List of areas covered""",
+        """## Audit Methodology
+1. Numbered methodology steps""",
+        """## Findings & Observations
 
 ### High-Risk Findings
 | # | Observation | Affected Control | Recommendation |
@@ -2048,50 +2193,30 @@ Brief overview of audit results with overall compliance percentage
 
 ### Low-Risk Findings
 | # | Observation | Affected Control | Recommendation |
-|---|-------------|-----------------|----------------|
-
-## Compliance Assessment
+|---|-------------|-----------------|----------------|""",
+        """## Compliance Assessment
 | Domain | Compliance Rate | Assessment |
 |--------|----------------|------------|
-| Area | XX% | Status |
-
-## Action Plan
+| Area | XX% | Status |""",
+        """## Action Plan
 | # | Action | Owner | Deadline | Priority |
 |---|--------|-------|----------|----------|
 | 1 | Action | Team | Date | High/Medium/Low |
 
 ---
 **Report Date:** [To be added]
-**Next Audit:** Within 6 months"""
-
-    if lang == 'ar':
-        prompt = f"""أنشئ تقرير تدقيق شامل بتنسيق Markdown احترافي لـ:
-الإطار: {framework}
-النطاق: {audit_scope}
-المجال: {domain}
-وثائق الإثبات: {', '.join(evidence_info) if evidence_info else 'لم يتم تقديم أدلة'}
-
-تعليمات صارمة ومهمة جداً:
-1. لا تستخدم أي تواريخ محددة مطلقاً (مثل 2024، 2025، يناير، فبراير، إلخ)
-2. لا تستخدم أي أسماء أشخاص أو مدققين
-3. استخدم فقط عبارات نسبية مثل: "خلال 30 يوم"، "خلال 60 يوم"، "خلال 90 يوم"
-4. للتواريخ استخدم: [سيتم إضافته]
-5. لفترة التدقيق استخدم: [فترة التدقيق]
-
-استخدم التنسيق التالي:
-
-# تقرير التدقيق
+**Next Audit:** Within 6 months""",
+    ),
+    'ar': (
+        """# تقرير التدقيق
 
 ## الملخص التنفيذي
-نظرة عامة موجزة على نتائج التدقيق مع نسبة الامتثال الإجمالية
-
-## نطاق التدقيق
-- قائمة بالمجالات المشمولة
-
-## منهجية التدقيق
-1. خطوات المنهجية مرقمة
-
-## النتائج والملاحظات
+نظرة عامة موجزة على نتائج التدقيق مع نسبة الامتثال الإجمالية""",
+        """## نطاق التدقيق
+- قائمة بالمجالات المشمولة""",
+        """## منهجية التدقيق
+1. خطوات المنهجية مرقمة""",
+        """## النتائج والملاحظات
 
 ### نتائج عالية الخطورة
 | # | الملاحظة | الضابط المتأثر | التوصية |
@@ -2104,210 +2229,256 @@ Brief overview of audit results with overall compliance percentage
 
 ### نتائج منخفضة الخطورة
 | # | الملاحظة | الضابط المتأثر | التوصية |
-|---|----------|---------------|---------|
-
-## تقييم الامتثال
+|---|----------|---------------|---------|""",
+        """## تقييم الامتثال
 | المجال | نسبة الامتثال | التقييم |
 |--------|--------------|---------|
-| المجال | XX% | الحالة |
-
-## خطة العمل
+| المجال | XX% | الحالة |""",
+        """## خطة العمل
 | # | الإجراء | المسؤول | الموعد النهائي | الأولوية |
 |---|--------|---------|---------------|----------|
 | 1 | الإجراء | الفريق | التاريخ | عالية/متوسطة/منخفضة |
 
 ---
 **تاريخ التقرير:** [سيتم إضافته]
-**التدقيق القادم:** خلال 6 أشهر"""
+**التدقيق القادم:** خلال 6 أشهر""",
+    ),
+}
 
-    content = generate_ai_content(prompt, lang)
+AUDIT_FORMAT_PROMPT = {
+    'en': "Use the following format:",
+    'ar': "استخدم التنسيق التالي:",
+}
+
+# Splits a full audit report before each "## " heading
+AUDIT_PART_RE = re.compile(r'\n(?=## )')
+
+def simulated_audit_parts(language='en'):
+    """Simulated audit report split into the six AUDIT_SECTION_FORMATS parts."""
+    title, *parts = AUDIT_PART_RE.split(generate_audit_simulation(language))
+    # The "# Audit Report" title belongs to the first part, as in the formats
+    parts[0] = f"{title}\n{parts[0]}"
+    return [part.strip() for part in parts]
+
+@app.route('/api/generate-audit', methods=['POST'])
+@login_required
+def api_generate_audit():
+    """Generate audit report."""
+    lang = request.form.get('language', 'en')
+    framework = request.form.get('framework', 'ISO 27001')
+    audit_scope = request.form.get('audit_scope', 'full')
+    domain = request.form.get('domain', 'Cyber Security')
+    
+    if 'framework' in request.form and not is_valid_selection(domain, frameworks=[framework]):
+        return jsonify({'success': False, 'error': 'Invalid framework'}), 400
+    
+    # Handle file upload
+    evidence_files = request.files.getlist('evidence')
+    evidence_info = []
+    for f in evidence_files:
+        if f and f.filename:
+            evidence_info.append(f.filename)
+    
+    if lang == 'ar':
+        prompt = f"""أنشئ تقرير تدقيق شامل بتنسيق Markdown احترافي لـ:
+الإطار: {framework}
+النطاق: {audit_scope}
+المجال: {domain}
+وثائق الإثبات: {', '.join(evidence_info) if evidence_info else 'لم يتم تقديم أدلة'}
+
+تعليمات صارمة ومهمة جداً:
+1. لا تستخدم أي تواريخ محددة مطلقاً (مثل 2024، 2025، يناير، فبراير، إلخ)
+2. لا تستخدم أي أسماء أشخاص أو مدققين
+3. استخدم فقط عبارات نسبية مثل: "خلال 30 يوم"، "خلال 60 يوم"، "خلال 90 يوم"
+4. للتواريخ استخدم: [سيتم إضافته]
+5. لفترة التدقيق استخدم: [فترة التدقيق]"""
+    else:
+        prompt = f"""Generate a comprehensive audit report in professional Markdown format for:
+Framework: {framework}
+Scope: {audit_scope}
+Domain: {domain}
+Evidence Documents: {', '.join(evidence_info) if evidence_info else 'No evidence provided'}
+
+STRICT AND IMPORTANT INSTRUCTIONS:
+1. Do NOT use any specific dates (like 2024, 2025, January, February, etc.)
+2. Do NOT use any person names or auditor names
+3. Use ONLY relative timeframes like: "Within 30 days", "Within 60 days", "Within 90 days"
+4. For dates use: [To be added]
+5. For audit period use: [Audit Period]"""
+    
+    prompt_lang = 'ar' if lang == 'ar' else 'en'
+    formats = AUDIT_SECTION_FORMATS[prompt_lang]
+    
+    # Report parts are independent, so with AI available they are generated concurrently.
+    # The audit context goes in the system message; each part prompt is just its format,
+    # and a failed part falls back to its simulated text instead of discarding the others
+    section_texts = generate_ai_contents(
+        [f"{ONE_SECTION_PROMPT[prompt_lang]}\n\n{fmt}" for fmt in formats],
+        simulated_audit_parts(lang), lang, context=prompt)
+    if section_texts is not None:
+        content = '\n\n'.join(text.strip() for text in section_texts)
+    else:
+        content = generate_ai_content(f"{prompt}\n\n{AUDIT_FORMAT_PROMPT[prompt_lang]}\n\n" + '\n\n'.join(formats), lang)
     return jsonify({'success': True, 'content': content})
 
+# Markdown line prefixes for Word export: "#" to "####" headings, "-", "*" or "•" bullets
+DOCX_PREFIX_RE = re.compile(r'(?:(#{1,4})|[-*•]) ')
+
 @app.route('/api/generate-docx', methods=['POST'])
 @login_required
 def api_generate_docx():
     """Generate Word document from content."""
-    from io import BytesIO
+    if Document is None:
+        return jsonify({'error': 'Word generation not available'}), 500
     
     data = request.json
     content = data.get('content', '')
     filename = data.get('filename', 'document')
     lang = data.get('language', 'en')
     
-    # DEBUG: Print what content we received
-    print("=" * 60)
-    print("DOCX GENERATION - Content received (first 300 chars):")
-    print(content[:300])
-    print("=" * 60)
+    doc = Document()
     
-    try:
-        from docx import Document
-        from docx.shared import Inches, Pt, Cm
-        from docx.enum.text import WD_ALIGN_PARAGRAPH
-        from docx.enum.table import WD_TABLE_ALIGNMENT
-        from docx.oxml.ns import nsdecls
-        from docx.oxml import parse_xml
-        
-        doc = Document()
+    # Set RTL for Arabic
+    if lang == 'ar':
+        for section in doc.sections:
+            section.page_width = Inches(8.5)
+            section.page_height = Inches(11)
+    
+    # Add title
+    title = doc.add_heading(filename.replace('_', ' ').title(), 0)
+    if lang == 'ar':
+        title.alignment = WD_ALIGN_PARAGRAPH.RIGHT
+    
+    def parse_markdown_table(lines, start_idx):
+        """Parse markdown table starting at start_idx, return (table_data, end_idx)."""
+        table_rows = []
+        i = start_idx
         
-        # Set RTL for Arabic
-        if lang == 'ar':
-            for section in doc.sections:
-                section.page_width = Inches(8.5)
-                section.page_height = Inches(11)
+        while i < len(lines):
+            line = lines[i].strip()
+            if line.startswith('|') and line.endswith('|'):
+                # Skip separator row (|---|---|)
+                if '---' in line or ':-' in line or '-:' in line:
+                    i += 1
+                    continue
+                # Parse table row
+                cells = [cell.strip() for cell in line.split('|')[1:-1]]
+                if cells:
+                    table_rows.append(cells)
+                i += 1
+            else:
+                break
         
-        # Add title
-        title = doc.add_heading(filename.replace('_', ' ').title(), 0)
-        if lang == 'ar':
-            title.alignment = WD_ALIGN_PARAGRAPH.RIGHT
+        return table_rows, i
+    
+    def add_table_to_doc(doc, table_data, lang):
+        """Add a formatted table to the document."""
+        if not table_data or len(table_data) < 1:
+            return
         
-        def parse_markdown_table(lines, start_idx):
-            """Parse markdown table starting at start_idx, return (table_data, end_idx)."""
-            table_rows = []
-            i = start_idx
-            
-            while i < len(lines):
-                line = lines[i].strip()
-                if line.startswith('|') and line.endswith('|'):
-                    # Skip separator row (|---|---|)
-                    if '---' in line or ':-' in line or '-:' in line:
-                        i += 1
-                        continue
-                    # Parse table row
-                    cells = [cell.strip() for cell in line.split('|')[1:-1]]
-                    if cells:
-                        table_rows.append(cells)
-                    i += 1
-                else:
-                    break
-            
-            return table_rows, i
+        num_cols = len(table_data[0])
+        table = doc.add_table(rows=len(table_data), cols=num_cols)
+        table.style = 'Table Grid'
         
-        def add_table_to_doc(doc, table_data, lang):
-            """Add a formatted table to the document."""
-            if not table_data or len(table_data) < 1:
-                return
-            
-            num_cols = len(table_data[0])
-            table = doc.add_table(rows=len(table_data), cols=num_cols)
-            table.style = 'Table Grid'
-            
-            # Add shading to header row
-            for i, row_data in enumerate(table_data):
-                row = table.rows[i]
-                for j, cell_text in enumerate(row_data):
-                    if j < len(row.cells):
-                        cell = row.cells[j]
-                        cell.text = cell_text
-                        
-                        # Style header row
-                        if i == 0:
-                            for paragraph in cell.paragraphs:
-                                for run in paragraph.runs:
-                                    run.bold = True
-                            # Add shading to header
-                            shading = parse_xml(f'<w:shd {nsdecls("w")} w:fill="4472C4"/>')
-                            cell._tc.get_or_add_tcPr().append(shading)
-                            # White text for header
-                            for paragraph in cell.paragraphs:
-                                for run in paragraph.runs:
-                                    run.font.color.rgb = None  # Will use theme color
-                        
-                        # Set alignment
+        # Add shading to header row
+        for i, row_data in enumerate(table_data):
+            row = table.rows[i]
+            for j, cell_text in enumerate(row_data):
+                if j < len(row.cells):
+                    cell = row.cells[j]
+                    cell.text = cell_text
+                    
+                    # Style header row
+                    if i == 0:
                         for paragraph in cell.paragraphs:
-                            if lang == 'ar':
-                                paragraph.alignment = WD_ALIGN_PARAGRAPH.RIGHT
-            
-            # Add some space after table
-            doc.add_paragraph()
+                            for run in paragraph.runs:
+                                run.bold = True
+                        # Add shading to header
+                        shading = parse_xml(f'<w:shd {nsdecls("w")} w:fill="4472C4"/>')
+                        cell._tc.get_or_add_tcPr().append(shading)
+                        # White text for header
+                        for paragraph in cell.paragraphs:
+                            for run in paragraph.runs:
+                                run.font.color.rgb = None  # Will use theme color
+                    
+                    # Set alignment
+                    for paragraph in cell.paragraphs:
+                        if lang == 'ar':
+                            paragraph.alignment = WD_ALIGN_PARAGRAPH.RIGHT
         
-        # Process content line by line
-        lines = content.split('\n')
-        i = 0
+        # Add some space after table
+        doc.add_paragraph()
+    
+    # Process content line by line
+    lines = content.split('\n')
+    i = 0
+    
+    while i < len(lines):
+        line = lines[i].strip()
         
-        while i < len(lines):
-            line = lines[i].strip()
-            
-            # Skip empty lines
-            if not line:
-                i += 1
-                continue
-            
-            # Skip separator lines
-            if line == '---':
-                doc.add_paragraph('')
-                i += 1
-                continue
-            
-            # Check if this is the start of a table
-            if line.startswith('|') and '|' in line[1:]:
-                table_data, new_idx = parse_markdown_table(lines, i)
-                if table_data:
-                    add_table_to_doc(doc, table_data, lang)
-                i = new_idx
-                continue
-            
-            # Handle markdown headings
-            if line.startswith('# ') and not line.startswith('## '):
-                h = doc.add_heading(line[2:], level=0)
-                if lang == 'ar':
-                    h.alignment = WD_ALIGN_PARAGRAPH.RIGHT
-            elif line.startswith('## '):
-                h = doc.add_heading(line[3:], level=1)
-                if lang == 'ar':
-                    h.alignment = WD_ALIGN_PARAGRAPH.RIGHT
-            elif line.startswith('### '):
-                h = doc.add_heading(line[4:], level=2)
-                if lang == 'ar':
-                    h.alignment = WD_ALIGN_PARAGRAPH.RIGHT
-            elif line.startswith('#### '):
-                h = doc.add_heading(line[5:], level=3)
-                if lang == 'ar':
-                    h.alignment = WD_ALIGN_PARAGRAPH.RIGHT
-            elif line.startswith('- ') or line.startswith('* ') or line.startswith('• '):
-                bullet_text = line[2:]
-                p = doc.add_paragraph(bullet_text, style='List Bullet')
-                if lang == 'ar':
-                    p.alignment = WD_ALIGN_PARAGRAPH.RIGHT
-            elif line.startswith('**') and line.endswith('**'):
-                p = doc.add_paragraph()
-                run = p.add_run(line[2:-2])
-                run.bold = True
-                if lang == 'ar':
-                    p.alignment = WD_ALIGN_PARAGRAPH.RIGHT
-            elif line.startswith('**') and '**' in line[2:]:
-                # Bold text at start of line
-                p = doc.add_paragraph()
-                parts = line.split('**')
-                for idx, part in enumerate(parts):
-                    if part:
-                        run = p.add_run(part)
-                        if idx % 2 == 1:  # Odd indices are bold
-                            run.bold = True
-                if lang == 'ar':
-                    p.alignment = WD_ALIGN_PARAGRAPH.RIGHT
-            else:
-                p = doc.add_paragraph(line)
-                if lang == 'ar':
-                    p.alignment = WD_ALIGN_PARAGRAPH.RIGHT
-            
+        # Skip empty lines
+        if not line:
             i += 1
+            continue
         
-        # Save to BytesIO
-        buffer = BytesIO()
-        doc.save(buffer)
-        buffer.seek(0)
+        # Skip separator lines
+        if line == '---':
+            doc.add_paragraph('')
+            i += 1
+            continue
         
-        from flask import send_file
-        return send_file(
-            buffer,
-            mimetype='application/vnd.openxmlformats-officedocument.wordprocessingml.document',
-            as_attachment=True,
-            download_name=f'{filename}.docx'
-        )
-    except ImportError:
-        # python-docx not installed, return error
-        return jsonify({'error': 'Word generation not available'}), 500
+        # Check if this is the start of a table
+        if line.startswith('|') and '|' in line[1:]:
+            table_data, new_idx = parse_markdown_table(lines, i)
+            if table_data:
+                add_table_to_doc(doc, table_data, lang)
+            i = new_idx
+            continue
+        
+        # Headings and bullets are told apart by a single prefix match
+        prefix = DOCX_PREFIX_RE.match(line)
+        if prefix:
+            text = line[prefix.end():]
+            if prefix.group(1):
+                p = doc.add_heading(text, level=len(prefix.group(1)) - 1)
+            else:
+                p = doc.add_paragraph(text, style='List Bullet')
+        elif line.startswith('**') and line.endswith('**'):
+            p = doc.add_paragraph()
+            run = p.add_run(line[2:-2])
+            run.bold = True
+        elif line.startswith('**') and '**' in line[2:]:
+            # Bold text at start of line
+            p = doc.add_paragraph()
+            parts = line.split('**')
+            for idx, part in enumerate(parts):
+                if part:
+                    run = p.add_run(part)
+                    if idx % 2 == 1:  # Odd indices are bold
+                        run.bold = True
+        else:
+            p = doc.add_paragraph(line)
+        
+        if lang == 'ar':
+            p.alignment = WD_ALIGN_PARAGRAPH.RIGHT
+        
+        i += 1
+    
+    # Small documents stay in memory; large ones spill to a temp file instead of pinning worker RAM
+    buffer = tempfile.SpooledTemporaryFile(max_size=config.DOCX_SPOOL_MAX_SIZE)
+    doc.save(buffer)
+    buffer.seek(0)
+    
+    response = send_file(
+        buffer,
+        mimetype='application/vnd.openxmlformats-officedocument.wordprocessingml.document',
+        as_attachment=True,
+        download_name=f'{filename}.docx'
+    )
+    # The document holds one user's generated content; never let a browser or proxy keep it
+    response.cache_control.private = True
+    response.cache_control.no_store = True
+    return response
 
 @app.route('/api/set-language/<lang>')
 def set_language(lang):
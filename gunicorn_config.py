@@ -1,5 +1,11 @@
 # Gunicorn configuration for Render deployment
+import os
+
 bind = "0.0.0.0:10000"
-workers = 2
-threads = 4
+# app.py reads the same variable to split OPENAI_MAX_RPM between workers
+workers = int(os.getenv("WEB_CONCURRENCY", "2"))
+# AI routes spend seconds waiting on OpenAI with the GIL released, so each worker
+# runs enough threads that slow completions do not queue up fast page loads
+worker_class = "gthread"
+threads = 16
 timeout = 120